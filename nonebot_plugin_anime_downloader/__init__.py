@@ -1,14 +1,18 @@
 import json
+import time
+import asyncio
 import nonebot
-from typing import List
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, Optional, Set
 from pathlib import Path
+from datetime import datetime
 from nonebot import require
 from nonebot.log import logger
 from nonebot import on_command
-from sqlalchemy import create_engine
 from nonebot.drivers import ASGIMixin
-from sqlalchemy.orm import sessionmaker
 from nonebot.plugin import PluginMetadata
+from nonebot.permission import SUPERUSER
 from nonebot.adapters import Event, Message
 from nonebot.params import CommandArg, Depends
 from nonebot.plugin import inherit_supported_adapters
@@ -21,26 +25,59 @@ import nonebot_plugin_localstore as store
 from nonebot_plugin_apscheduler import scheduler
 from nonebot_plugin_alconna import UniMessage, Target
 
-from .config import Config
+from .config import DEFAULT_PIPELINE_WORKERS, Config
+from .models import DownloadJob, Task
 from .tasks import TaskManager
+from .pipeline import Pipeline, Stage
+from .polling import (
+    HISTORY_DAYS,
+    SUBSCRIBED_WEIGHT,
+    AdaptiveIntervalTrigger,
+    ReleaseProfile,
+)
+from .torrent_cache import TorrentCache
+from .search_cache import SearchCache
+from .storage import StorageManager
+from .webhook import register_webhook
+from .tracing import Tracer, current_trace, span
+from .metrics import (
+    ENTRIES_INGESTED,
+    JOB_SECONDS,
+    STORAGE_USAGE_BYTES,
+    TASKS,
+    register_metrics,
+    timed,
+)
 from .routes import VideoManager
+from .streaming import open_stream
+from .faststart import FaststartError, faststart
+from .matcher import SubscriptionMatcher
 from .downloader import TorrentDownloader
-from .downloader.exceptions import TorrentExistsError
-from .data_source import ACGRIPBase, UserBase, VideoBase, ACGRIPData, User, Video
-from .utils import is_tag_match_title, generate_folder_name, extract_tags_from_title
+from .downloader.models import TorrentInfo
+from .downloader.bencode import get_info_hashes
+from .downloader.exceptions import TorrentExistsError, TorrentUnexistsError
+from .data_source import Video
+from .utils import find_videos, generate_folder_name, extract_tags_from_title
+from .database import (
+    Database,
+    ACGRIPRepository,
+    StateRepository,
+    UserRepository,
+    VideoRepository,
+)
 from .acgrip import (
-    make_request,
-    extract_data,
+    fetch_data,
+    close_session,
+    get_page_data,
     get_anime_data,
     fetch_torrent_data,
-    replace_html_entities,
 )
 
 
 __plugin_meta__ = PluginMetadata(
     name="番剧下载",
     description="基于 qBittorrent Web UI 的番剧下载 NoneBot 插件",
-    usage="/sub 订阅 Tag\n/unsub 取消订阅 Tag\n/listsub 查看订阅列表\n/anmsc 搜索番剧\n/anmd 下载番剧",
+    usage="/sub 订阅 Tag\n/unsub 取消订阅 Tag\n/listsub 查看订阅列表\n/anmsc 搜索番剧\n/anmd 下载番剧\n/anmtrace 查看定时任务耗时（超级用户）",
     type="application",
     homepage="https://github.com/zhaomaoniu/nonebot-plugin-anime-downloader",
     config=Config,
@@ -65,10 +102,17 @@ if not download_path.exists():
             f"无法创建下载目录！请自行创建下载目录后重启 NoneBot. 本次下载目录为: {download_path}"
         )
 
-tasks_file = store.get_data_file("nonebot_plugin_anime_downloader", "tasks.json")
+tasks_file = store.get_data_file("nonebot_plugin_anime_downloader", "tasks.jsonl")
 
 task_manager = TaskManager(tasks_file)
-video_manager = VideoManager(nonebot.get_app(), download_path)
+torrent_cache = TorrentCache(
+    store.get_cache_dir("nonebot_plugin_anime_downloader") / "torrents"
+)
+video_manager = VideoManager(
+    nonebot.get_app(),
+    download_path,
+    cache_size=plugin_config.anime_cache_size * 1024 * 1024,
+)
 
 torrent_downloader = TorrentDownloader(
     plugin_config.qbittorrent_host,
@@ -77,28 +121,111 @@ torrent_downloader = TorrentDownloader(
     download_path,
 )
 
-acg_rip_file = store.get_data_file("nonebot_plugin_anime_downloader", "acgrip.db")
-user_file = store.get_data_file("nonebot_plugin_anime_downloader", "users.db")
-video_file = store.get_data_file("nonebot_plugin_anime_downloader", "videos.db")
+database = Database(
+    store.get_data_file("nonebot_plugin_anime_downloader", "anime.db")
+)
+acgrip_repository = ACGRIPRepository(database)
+user_repository = UserRepository(database)
+video_repository = VideoRepository(database)
+state_repository = StateRepository(database)
+
+subscription_matcher = SubscriptionMatcher()
+
+# highest ACG.RIP torrent id the poller has seen, persisted in the state
+# table, since /anmsc stores entries the poller hasn't seen in acgrip as well
+acgrip_watermark: Optional[int] = None
+
+# ids of polled entries still in the download pipeline; every polled entry
+# up to the persisted pipeline watermark has left it, so the ones above are
+# queued again after a restart
+polled_in_pipeline: Set[int] = set()
+saved_pipeline_watermark: Optional[int] = None
+watermark_lock = asyncio.Lock()
+
+# pages fetched at the same time while catching up
+ACGRIP_PAGE_CONCURRENCY = 3
+
+# when adaptive polling is on, learns when releases arrive
+release_profile = ReleaseProfile()
+PROFILE_REFRESH_INTERVAL = 24 * 3600
+
+tracer = Tracer(
+    plugin_config.anime_tracing,
+    plugin_config.anime_tracing_size,
+    store.get_cache_dir("nonebot_plugin_anime_downloader") / "profiles",
+    plugin_config.anime_profile_threshold,
+    plugin_config.anime_profile_sample_rate,
+)
 
-acg_rip_engine = create_engine(f"sqlite:///{acg_rip_file.resolve()}")
-user_engine = create_engine(f"sqlite:///{user_file.resolve()}")
-video_engine = create_engine(f"sqlite:///{video_file.resolve()}")
+# one poll at a time, whether started by the scheduler or on startup
+acgrip_lock = asyncio.Lock()
 
-ACGRIPBase.metadata.create_all(acg_rip_engine)
-UserBase.metadata.create_all(user_engine)
-VideoBase.metadata.create_all(video_engine)
+# rewriting is disk bound, a couple of files at a time keeps up with downloads
+FASTSTART_WORKERS = 2
+faststart_executor = ThreadPoolExecutor(
+    max_workers=FASTSTART_WORKERS, thread_name_prefix="faststart"
+)
+# outside the torrent folders, so seeding is not affected
+faststart_dir = download_path / ".faststart"
+
+# stat calls on a network share are slow, the catalog is verified in parallel
+VERIFY_WORKERS = 8
 
-acgrip_session = sessionmaker(bind=acg_rip_engine)()
-user_session = sessionmaker(bind=user_engine)()
-video_session = sessionmaker(bind=video_engine)()
+# jobs fetching and adding a torrent, by ACG.RIP id
+pending_downloads: Dict[int, DownloadJob] = {}
 
+storage_manager = StorageManager(
+    download_path,
+    int(plugin_config.anime_storage_quota * 1024**3),
+    plugin_config.anime_storage_low_watermark,
+    video_repository,
+    video_manager,
+    torrent_downloader,
+    # torrents being downloaded or announced are never evicted
+    lambda torrent_id: (
+        torrent_id in pending_downloads or task_manager.find(torrent_id) is not None
+    ),
+)
+STORAGE_CHECK_INTERVAL = 600
 
-async def send_notification(title: str, torrent_id: int, user_id: str):
-    msg = (
-        f"{title} 现在可以观看了！\n"
-        + f"{plugin_config.anime_url}:{nonebot.get_driver().config.port}/anime/{torrent_id}"
+# strong references to fire-and-forget tasks, which asyncio only keeps weakly
+background_tasks: Set["asyncio.Task[None]"] = set()
+
+
+@nonebot.get_driver().on_startup
+async def init_database():
+    global acgrip_watermark
+
+    await database.init(
+        {
+            table: store.get_data_file("nonebot_plugin_anime_downloader", file)
+            for table, file in (
+                ("acgrip", "acgrip.db"),
+                ("users", "users.db"),
+                ("videos", "videos.db"),
+            )
+        }
     )
+
+    acgrip_watermark = await state_repository.get("acgrip_watermark")
+    if acgrip_watermark is None:
+        # older versions kept no watermark, only polled entries were stored
+        acgrip_watermark = await acgrip_repository.max_id()
+
+    for user in await user_repository.all():
+        for tags in json.loads(user.tags):
+            subscription_matcher.add(user.id, tags)
+
+
+def get_video_links(videos: List[Video]) -> str:
+    base_url = f"{plugin_config.anime_url}:{nonebot.get_driver().config.port}/anime"
+    if len(videos) == 1:
+        return f"{base_url}/{videos[0].id}"
+    return "\n".join(f"{video.episode}: {base_url}/{video.id}" for video in videos)
+
+
+async def send_notification(title: str, videos: List[Video], user_id: str):
+    msg = f"{title} 现在可以观看了！\n" + get_video_links(videos)
     chat_type = str(user_id).split("_")[0]
     id_ = str(user_id).split("_")[-1]
     target = Target(
@@ -111,143 +238,694 @@ async def send_notification(title: str, torrent_id: int, user_id: str):
     logger.info(f"Message sent to {user_id}!")
 
 
-@scheduler.scheduled_job("interval", seconds=plugin_config.acgrip_interval)
-@nonebot.get_driver().on_startup
-async def fetch_acgrip_data():
-    html_content = await make_request(base_url=plugin_config.acgrip_url)
-    data = extract_data(replace_html_entities(html_content))
+async def notify_users(title: str, videos: List[Video], user_ids: List[str]) -> None:
+    with span("notify"):
+        results = await asyncio.gather(
+            *(send_notification(title, videos, user_id) for user_id in user_ids),
+            return_exceptions=True,
+        )
+    # one unreachable chat must not keep the others from being notified
+    for user_id, result in zip(user_ids, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to notify {user_id} of {title}: {result}")
+
 
-    # get new data
-    new_data = []
-    for entry in data:
-        if acgrip_session.query(ACGRIPData).filter_by(id=entry["id"]).first() is None:
-            new_data.append(entry)
+def release_weight(title: str) -> float:
+    return SUBSCRIBED_WEIGHT if subscription_matcher.match(title) else 1.0
 
-    if new_data == []:
-        logger.debug("No new data found.")
+
+async def refresh_release_profile() -> None:
+    releases = await acgrip_repository.release_times(
+        int(time.time()) - HISTORY_DAYS * 24 * 3600
+    )
+    release_profile.rebuild(
+        (timestamp, release_weight(title)) for timestamp, title in releases
+    )
+    logger.debug(f"Release profile rebuilt from {len(releases)} releases.")
+
+
+def get_poll_interval(now: datetime) -> float:
+    interval = release_profile.interval(
+        now.timestamp(),
+        plugin_config.acgrip_min_interval,
+        plugin_config.acgrip_max_interval,
+    )
+    if interval is None:
+        # nothing learned yet, e.g. on a fresh install
+        interval = min(
+            max(plugin_config.acgrip_interval, plugin_config.acgrip_min_interval),
+            plugin_config.acgrip_max_interval,
+        )
+    logger.debug(f"Next ACG.RIP poll in {interval:.0f}s.")
+    return interval
+
+
+@timed(JOB_SECONDS, job="poll_acgrip")
+@tracer.traced("poll_acgrip")
+async def poll_acgrip():
+    # the scheduler only skips its own overlapping runs, not the startup poll
+    if acgrip_lock.locked():
+        logger.debug("The last ACG.RIP poll is still running, skipping.")
         return None
 
-    logger.info(f"ACG.RIP updated with {len(new_data)} new entries.")
+    async with acgrip_lock:
+        if (
+            plugin_config.acgrip_adaptive
+            and time.time() - release_profile.built_at > PROFILE_REFRESH_INTERVAL
+        ):
+            await refresh_release_profile()
+        await fetch_acgrip_data()
+
+
+if plugin_config.acgrip_adaptive:
+    scheduler.add_job(
+        poll_acgrip,
+        AdaptiveIntervalTrigger(get_poll_interval),
+        max_instances=1,
+        coalesce=True,
+    )
+else:
+    scheduler.add_job(
+        poll_acgrip,
+        "interval",
+        seconds=plugin_config.acgrip_interval,
+        max_instances=1,
+        coalesce=True,
+    )
 
-    # store new data
-    for entry in new_data:
-        acgrip_session.add(ACGRIPData(**entry))
-    acgrip_session.commit()
-
-    # check if any user is interested in the new data
-    users = user_session.query(User).all()
-    for user in users:
-        tags_str = user.tags
-        tags_list: List[List[str]] = json.loads(tags_str)
-        for tags in tags_list:
-            for entry in new_data:
-                if is_tag_match_title(tags, entry["title"]):
-                    # check if the video is already downloaded
-                    if entry["id"] in video_manager.ids:
-                        await send_notification(entry["title"], entry["id"], user.id)
-                        continue
-
-                    # start download torrent
-                    logger.info(f"Downloading {entry['title']} for {user.id}...")
-
-                    if str(entry["url"]).startswith("http"):
-                        url = f"{entry['url']}.torrent"
-                    else:
-                        url = f"{plugin_config.acgrip_url}{entry['url']}.torrent"
-
-                    torrent_data = await fetch_torrent_data(url)
-                    try:
-                        torrent_info = await torrent_downloader.download_torrent(
-                            torrent_data, generate_folder_name(tags)
-                        )
-                    except TorrentExistsError:
-                        logger.warning(
-                            f"Torrent {entry['title']} already exists in the download queue."
-                        )
-                        continue
-                    except Exception:
-                        logger.warning(
-                            f"Failed to download {entry['title']} for {user.id}! Probably due to the same torrent."
-                        )
-                    task_manager.add(
-                        {
-                            "id": user.id,
-                            "content": torrent_info,
-                            "torrent_id": int(entry["id"]),
-                            "status": "downloading",
-                        }
-                    )
-
-
-@scheduler.scheduled_job("interval", seconds=60)
-async def check_for_tasks():
-    for task in task_manager.content:
-        hash_str = task["content"]["hash"]
 
-        torrent_info = await torrent_downloader.get_torrent_info(hash_str)
+async def fetch_acgrip_data():
+    global acgrip_watermark
 
-        if torrent_info["progress"] == 1:
-            logger.info(f"Torrent {task['content']['name']} downloaded.")
-            task["status"] = "downloaded"
-            task_manager.save()
+    with span("http"):
+        data = await fetch_data(base_url=plugin_config.acgrip_url, conditional=True)
+    if data is None:
+        logger.debug("ACG.RIP not modified.")
+        return None
 
-        if task["status"] == "downloaded":
-            existing_video = (
-                video_session.query(Video).filter_by(id=task["torrent_id"]).first()
+    # get new data, catching up on pages that scrolled past since the last poll
+    entries: Dict[int, Dict[str, str]] = {}
+    page = 1
+    while True:
+        entries.update((int(entry["id"]), entry) for entry in data)
+
+        if (
+            acgrip_watermark is None
+            or not data
+            or min(int(entry["id"]) for entry in data) <= acgrip_watermark
+            or page >= plugin_config.acgrip_catch_up_pages
+        ):
+            break
+
+        pages = range(
+            page + 1,
+            min(page + ACGRIP_PAGE_CONCURRENCY, plugin_config.acgrip_catch_up_pages) + 1,
+        )
+        with span("http"):
+            results = await asyncio.gather(
+                *(get_page_data(page, plugin_config.acgrip_url) for page in pages)
             )
-            if existing_video is None:
-                video_session.add(
-                    Video(
-                        id=task["torrent_id"],
-                        title=torrent_info["name"],
-                        path=f"{torrent_info['save_path']}\\{torrent_info['name']}",
-                    )
-                )
+        # only the last page of the batch decides whether to keep going
+        for result in results[:-1]:
+            entries.update((int(entry["id"]), entry) for entry in result)
+        data = results[-1]
+        page = pages[-1]
+
+    with span("db_diff"):
+        new_data = [
+            entry
+            for id_, entry in sorted(entries.items())
+            if acgrip_watermark is None or id_ > acgrip_watermark
+        ]
+
+        if new_data == []:
+            logger.debug("No new data found.")
+            return None
+
+        logger.info(f"ACG.RIP updated with {len(new_data)} new entries.")
+
+        # store new data
+        await acgrip_repository.add_all(new_data)
+        acgrip_watermark = int(new_data[-1]["id"])
+        polled_in_pipeline.update(int(entry["id"]) for entry in new_data)
+        await save_watermarks()
+    ENTRIES_INGESTED.inc(len(new_data))
+
+    if plugin_config.acgrip_adaptive:
+        for entry in new_data:
+            if entry.get("time", "").isdigit():
+                release_profile.add(int(entry["time"]), release_weight(entry["title"]))
+
+    # the pipeline matches and downloads them, so a slow torrent can't hold up the poll
+    for entry in new_data:
+        download_pipeline.put(
+            {"title": entry["title"], "entry": entry, "trace": current_trace()}
+        )
 
-            video_session.commit()
 
-            if not Path(
-                f"{torrent_info['save_path']}\\{torrent_info['name']}"
-            ).exists():
-                continue
+def get_pipeline_watermark() -> Optional[int]:
+    if polled_in_pipeline:
+        return min(polled_in_pipeline) - 1
+    return acgrip_watermark
 
-            video_manager.add_route(
-                Path(f"{torrent_info['save_path']}\\{torrent_info['name']}"),
-                task["torrent_id"],
+
+async def save_watermarks() -> None:
+    global saved_pipeline_watermark
+
+    # writes are serialized and each writes the latest values, so a slow
+    # write can't overwrite a newer one
+    async with watermark_lock:
+        if acgrip_watermark is None:
+            return None
+        pipeline_watermark = get_pipeline_watermark()
+        await state_repository.set(
+            {"acgrip_watermark": acgrip_watermark, "pipeline_watermark": pipeline_watermark}
+        )
+        saved_pipeline_watermark = pipeline_watermark
+
+
+def finish_job(job: DownloadJob) -> None:
+    """Mark the entry of a scheduled job as done with, whatever the outcome."""
+    if "entry" not in job:
+        return None
+    polled_in_pipeline.discard(int(job["entry"]["id"]))
+    if get_pipeline_watermark() != saved_pipeline_watermark:
+        run_in_background(save_watermarks())
+
+
+def merge_user_ids(user_ids: List[str], new_user_ids: List[str]) -> bool:
+    new_ids = [user_id for user_id in new_user_ids if user_id not in user_ids]
+    user_ids.extend(new_ids)
+    return bool(new_ids)
+
+
+def claim_download(job: DownloadJob) -> bool:
+    """Make a job the download of its torrent, or merge it into the existing one.
+
+    Jobs for a torrent that is already being fetched and added share its
+    future, and their users end up on the same task.
+
+    Returns:
+        Whether the job has to fetch and add the torrent itself.
+    """
+    torrent_id = job["torrent_id"]
+
+    pending = pending_downloads.get(torrent_id)
+    if pending is not None:
+        merge_user_ids(pending["user_ids"], job["user_ids"])
+        job["future"] = pending["future"]
+        return False
+
+    future: "asyncio.Future[Task]" = asyncio.get_running_loop().create_future()
+    # scheduled jobs have nobody awaiting them, failures are logged instead
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    job["future"] = future
+
+    task = task_manager.find(torrent_id)
+    if task is not None:
+        if merge_user_ids(task["ids"], job["user_ids"]):
+            task_manager.update(task)
+        future.set_result(task)
+        return False
+
+    pending_downloads[torrent_id] = job
+    return True
+
+
+async def match_entry(job: DownloadJob) -> bool:
+    entry = job["entry"]
+
+    # in the order they were subscribed, the oldest subscription names the folder
+    matches = subscription_matcher.match(entry["title"])
+    if not matches:
+        return False
+    # a user may match through several subscriptions
+    user_ids = list(dict.fromkeys(user_id for user_id, _ in matches))
+
+    # check if the video is already downloaded
+    videos = [
+        video
+        for video in await video_repository.get_by_torrent(int(entry["id"]))
+        if video.id in video_manager
+    ]
+    if videos:
+        await notify_users(entry["title"], videos, user_ids)
+        return False
+
+    logger.info(f"Downloading {entry['title']} for {', '.join(user_ids)}...")
+
+    if str(entry["url"]).startswith("http"):
+        url = f"{entry['url']}.torrent"
+    else:
+        url = f"{plugin_config.acgrip_url}{entry['url']}.torrent"
+
+    job.update(
+        torrent_id=int(entry["id"]),
+        url=url,
+        folder_name=generate_folder_name(list(matches[0][1])),
+        user_ids=user_ids,
+    )
+    return claim_download(job)
+
+
+async def fetch_torrent(job: DownloadJob) -> bool:
+    torrent_data = torrent_cache.get(job["torrent_id"])
+    if torrent_data is None:
+        torrent_data = await fetch_torrent_data(job["url"])
+        torrent_cache.put(job["torrent_id"], torrent_data)
+
+    job["torrent_data"] = torrent_data
+    return True
+
+
+async def add_torrent(job: DownloadJob) -> bool:
+    if job.get("add_attempted"):
+        # an attempt that timed out may have added the torrent after all
+        hash_str = get_info_hashes(job["torrent_data"]).id
+        torrents = await torrent_downloader.get_torrents_info([hash_str])
+        if hash_str in torrents:
+            job["torrent_info"] = torrents[hash_str]
+            return True
+
+    job["add_attempted"] = True
+    job["torrent_info"] = await torrent_downloader.download_torrent(
+        job["torrent_data"], job["folder_name"], sequential=plugin_config.anime_streaming
+    )
+    return True
+
+
+async def record_task(job: DownloadJob) -> bool:
+    task: Task = {
+        "ids": list(job["user_ids"]),
+        "content": job["torrent_info"],
+        "torrent_id": job["torrent_id"],
+        "status": "downloading",
+    }
+    task_manager.add(task)
+
+    # from here on, new users of the torrent are merged into the task
+    pending_downloads.pop(job["torrent_id"], None)
+    job["future"].set_result(task)
+    return False
+
+
+def fail_download(job: DownloadJob, e: Exception) -> None:
+    # the id lets a lost download be started again with /anmd
+    torrent_id = job["entry"]["id"] if "entry" in job else job.get("torrent_id")
+    if isinstance(e, TorrentExistsError):
+        logger.warning(
+            f"Torrent {job['title']} (ACG.RIP id {torrent_id}) already exists "
+            "in the download queue."
+        )
+    else:
+        logger.warning(
+            f"Failed to download {job['title']} (ACG.RIP id {torrent_id})! "
+            f"{type(e).__name__}: {e}"
+        )
+    finish_job(job)
+
+    if "torrent_id" in job and pending_downloads.get(job["torrent_id"]) is job:
+        pending_downloads.pop(job["torrent_id"])
+    if "future" in job and not job["future"].done():
+        job["future"].set_exception(e)
+
+
+def make_stage(name: str, handler: Callable[[DownloadJob], Awaitable[bool]]) -> Stage:
+    async def traced_handler(job: DownloadJob) -> bool:
+        # spans of queued work go to the trace of the poll that queued it
+        with span(name, trace=job.get("trace")):
+            passed = await handler(job)
+        if not passed:
+            finish_job(job)
+        return passed
+
+    return Stage(
+        name,
+        traced_handler,
+        # stages left out of the config keep their default
+        workers=plugin_config.pipeline_workers.get(name, DEFAULT_PIPELINE_WORKERS[name]),
+        timeout=plugin_config.pipeline_timeout,
+        retries=plugin_config.pipeline_retries,
+        on_error=fail_download,
+        # qBittorrent won't take a torrent twice, no matter how often it's asked
+        no_retry=(TorrentExistsError,),
+    )
+
+
+download_pipeline: Pipeline[DownloadJob] = Pipeline(
+    [
+        make_stage("match", match_entry),
+        make_stage("fetch", fetch_torrent),
+        make_stage("add", add_torrent),
+        make_stage("record", record_task),
+    ]
+)
+
+
+@nonebot.get_driver().on_startup
+async def start_download_pipeline():
+    download_pipeline.start()
+
+    # entries polled before the last shutdown that never made it through
+    pipeline_watermark = await state_repository.get("pipeline_watermark")
+    if pipeline_watermark is None or acgrip_watermark is None:
+        return None
+    entries = await acgrip_repository.get_range(pipeline_watermark, acgrip_watermark)
+    for entry in entries:
+        polled_in_pipeline.add(int(entry["id"]))
+        download_pipeline.put({"title": entry["title"], "entry": entry, "trace": None})
+    if entries:
+        logger.info(f"Queued {len(entries)} entries left in the pipeline at the last shutdown.")
+
+
+@nonebot.get_driver().on_startup
+async def start_polling():
+    # the first poll runs in the background, so startup doesn't wait on ACG.RIP
+    run_in_background(poll_acgrip())
+
+
+async def download_for_users(
+    title: str, torrent_id: int, url: str, folder_name: str, user_ids: List[str]
+) -> Task:
+    """Download a torrent and notify users once it can be watched.
+
+    Concurrent calls for the same torrent share one .torrent fetch and one
+    qBittorrent add, and all their users end up on the same task.
+
+    Args:
+        title: The title of the torrent, for logging.
+        torrent_id: The ACG.RIP id of the torrent.
+        url: The URL of the .torrent file.
+        folder_name: The folder under the download path to save to.
+        user_ids: The group/private_ids to notify.
+
+    Returns:
+        The task of the torrent.
+    """
+    job: DownloadJob = {
+        "title": title,
+        "torrent_id": torrent_id,
+        "url": url,
+        "folder_name": folder_name,
+        "user_ids": list(user_ids),
+    }
+    if claim_download(job):
+        # the users asked for it, so it skips matching against subscriptions
+        download_pipeline["fetch"].put(job)
+
+    return await asyncio.shield(job["future"])
+
+
+async def start_streaming(task: Task, torrent_info: TorrentInfo) -> Optional[Video]:
+    for video in await video_repository.get_by_torrent(task["torrent_id"]):
+        if video.id in video_manager.streams:
+            return video
+
+    # the buffer can't be there yet, so spare qBittorrent the file and piece calls
+    buffer_size = plugin_config.anime_streaming_buffer * 1024 * 1024
+    size = torrent_info.get("size", 0)
+    if torrent_info.get("progress", 0) * size < min(buffer_size, size):
+        return None
+
+    stream = await open_stream(torrent_downloader, torrent_info, buffer_size)
+    if stream is None:
+        return None
+
+    # cataloged where the file ends up, so the link stays once it is finished
+    (video,) = await video_repository.add_torrent_videos(
+        task["torrent_id"], torrent_info["name"], [stream.final_path], task["content"]["hash"]
+    )
+    video_manager.add_stream(stream, video.id)
+    logger.success(f"Streaming video {stream.path.name}.")
+    return video
+
+
+def log_background_error(task: "asyncio.Task[None]") -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.opt(exception=task.exception()).error("A background task failed.")
+
+
+def run_in_background(coroutine: Coroutine[Any, Any, None]) -> None:
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    task.add_done_callback(log_background_error)
+
+
+def get_video_path(video: Video) -> Path:
+    if video.faststart_path is not None and Path(video.faststart_path).exists():
+        return Path(video.faststart_path)
+    return Path(video.path)
+
+
+def find_video_file(video: Video) -> Optional[Path]:
+    for path in (video.faststart_path, video.path):
+        if path is not None and Path(path).exists():
+            return Path(path)
+    return None
+
+
+async def verify_videos(videos: List[Video]) -> None:
+    """Check the files of videos registered from the catalog without a stat call.
+
+    Videos whose files are gone are removed, and videos whose faststart copy
+    is gone fall back to the original file.
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(VERIFY_WORKERS, thread_name_prefix="verify") as executor:
+        paths = await asyncio.gather(
+            *(loop.run_in_executor(executor, find_video_file, video) for video in videos)
+        )
+
+    missing = 0
+    for video, path in zip(videos, paths):
+        # skip videos that were replaced, e.g. by a new faststart copy, meanwhile
+        if video_manager.videos.get(video.id) != Path(video.faststart_path or video.path):
+            continue
+        if path is None:
+            video_manager.remove_video(video.id)
+            missing += 1
+        else:
+            video_manager.add_video(path, video.id)
+
+    logger.info(f"Verified {len(videos)} videos, {missing} of them are missing.")
+
+
+async def optimize_video(video: Video) -> None:
+    source = Path(video.path)
+    target = faststart_dir / f"{video.id}{source.suffix.lower()}"
+    try:
+        rewritten = await asyncio.get_running_loop().run_in_executor(
+            faststart_executor, faststart, source, target
+        )
+    except (OSError, FaststartError) as e:
+        logger.warning(f"Failed to move the moov of {source.name} to the front: {e}")
+        return None
+
+    if not rewritten:
+        return None
+
+    await video_repository.set_faststart_path(video.id, target)
+    video_manager.add_video(target, video.id)
+    logger.success(f"Moved the moov of {source.name} to the front.")
+
+
+async def optimize_videos(videos: List[Video]) -> None:
+    await asyncio.gather(
+        *(optimize_video(video) for video in videos if video.faststart_path is None)
+    )
+
+
+async def process_task(task: Task, torrent_info: TorrentInfo) -> None:
+    if (
+        plugin_config.anime_streaming
+        and torrent_info["progress"] < 1
+        and task["status"] in ("downloading", "streaming")
+    ):
+        # streams don't survive a restart, so streaming tasks open them again
+        video = await start_streaming(task, torrent_info)
+        if video is not None and task["status"] == "downloading":
+            await notify_users(torrent_info["name"], [video], task["ids"])
+
+            task["status"] = "streaming"
+            task_manager.update(task)
+
+            logger.info(
+                f"Notification of {torrent_info['name']} sent for {', '.join(task['ids'])}."
             )
 
-            logger.success(f"Added route for video {torrent_info['name']}.")
+    if torrent_info["progress"] == 1 and task["status"] in ("downloading", "streaming"):
+        logger.info(f"Torrent {task['content']['name']} downloaded.")
+        # the link of a streamed video was sent already
+        task["status"] = "downloaded" if task["status"] == "downloading" else "streamed"
+        task_manager.update(task)
 
-            task["status"] = "wait_for_send"
+    if task["status"] in ("downloaded", "streamed"):
+        with span("catalog"):
+            video_paths = await asyncio.get_running_loop().run_in_executor(
+                None, find_videos, Path(torrent_info["content_path"])
+            )
+            if not video_paths:
+                logger.warning(f"No video found in {torrent_info['content_path']}.")
+                return None
 
-        if task["status"] == "wait_for_send":
-            await send_notification(
-                torrent_info["name"], task["torrent_id"], task["id"]
+            videos = await video_repository.add_torrent_videos(
+                task["torrent_id"],
+                torrent_info["name"],
+                video_paths,
+                task["content"]["hash"],
             )
+        video_manager.add_videos(
+            [get_video_path(video) for video in videos], [video.id for video in videos]
+        )
+        if plugin_config.anime_faststart:
+            run_in_background(optimize_videos(videos))
+        if storage_manager.enabled:
+            run_in_background(storage_manager.enforce())
 
+        # a pack still has episodes nobody was told about
+        if task["status"] == "streamed" and len(videos) == 1:
             task["status"] = "sent"
-            task_manager.save()
+            task_manager.update(task)
+            return None
 
-            logger.info(
-                f"Notification of {torrent_info['name']} sent for {task['id']}."
-            )
+        task["status"] = "wait_for_send"
 
-    # remove sent tasks
-    task_manager.content = [
-        task for task in task_manager.content if task["status"] != "sent"
-    ]
-    task_manager.save()
+    if task["status"] == "wait_for_send":
+        videos = await video_repository.get_by_torrent(task["torrent_id"])
+        await notify_users(torrent_info["name"], videos, task["ids"])
+
+        task["status"] = "sent"
+        task_manager.update(task)
+
+        logger.info(
+            f"Notification of {torrent_info['name']} sent for {', '.join(task['ids'])}."
+        )
+
+
+async def process_task_safely(task: Task, torrent_info: TorrentInfo) -> None:
+    # one failing task must not hold up the others, it is retried next time
+    try:
+        await process_task(task, torrent_info)
+    except Exception as e:
+        logger.opt(exception=e).error(
+            f"Failed to process the task of {task['content']['name']}."
+        )
+
+
+def remove_sent_tasks() -> None:
+    for task in task_manager.content:
+        if task["status"] == "sent":
+            task_manager.remove(task)
+
+
+# the webhook and the fallback poll must not process the same task twice
+task_lock = asyncio.Lock()
+
+
+@scheduler.scheduled_job(
+    "interval",
+    seconds=(
+        plugin_config.task_reconcile_interval
+        # streams are published on progress, which the webhook doesn't report
+        if plugin_config.qbittorrent_webhook_token and not plugin_config.anime_streaming
+        else 60
+    ),
+    max_instances=1,
+    coalesce=True,
+)
+@timed(JOB_SECONDS, job="check_for_tasks")
+@tracer.traced("check_for_tasks")
+async def check_for_tasks():
+    if not task_manager.content:
+        return None
+
+    async with task_lock:
+        with span("sync"):
+            torrents = await torrent_downloader.sync_torrents()
+
+        for task in task_manager.content:
+            torrent_info = torrents.get(task["content"]["hash"])
+            if torrent_info is None:
+                logger.warning(
+                    f"Torrent {task['content']['name']} is not in qBittorrent."
+                )
+                continue
+
+            with span("process_task"):
+                await process_task_safely(task, torrent_info)
+
+        remove_sent_tasks()
+
+
+async def on_torrent_finished(hash_str: str) -> bool:
+    async with task_lock:
+        tasks = [
+            task for task in task_manager.content if task["content"]["hash"] == hash_str
+        ]
+        if not tasks:
+            return False
+
+        try:
+            torrent_info = await torrent_downloader.get_torrent_info(hash_str)
+        except TorrentUnexistsError:
+            logger.warning(f"Torrent {hash_str} was reported finished but is not in qBittorrent.")
+            return False
+        for task in tasks:
+            await process_task_safely(task, torrent_info)
+
+        remove_sent_tasks()
+        return True
+
+
+@scheduler.scheduled_job(
+    "interval", seconds=STORAGE_CHECK_INTERVAL, max_instances=1, coalesce=True
+)
+async def enforce_storage_quota():
+    await storage_manager.enforce()
+
+
+TASKS.set_function(
+    lambda: {
+        (status,): count
+        for status, count in Counter(task["status"] for task in task_manager.content).items()
+    }
+)
+
+STORAGE_USAGE_BYTES.set_function(
+    lambda: {} if storage_manager.usage is None else {(): storage_manager.usage}
+)
+
+if plugin_config.anime_metrics:
+    register_metrics(video_manager.app)
+
+if plugin_config.qbittorrent_webhook_token:
+    register_webhook(
+        video_manager.app, plugin_config.qbittorrent_webhook_token, on_torrent_finished
+    )
 
 
 @nonebot.get_driver().on_startup
 async def check_for_new_videos():
-    videos = video_session.query(Video).all()
+    videos = await video_repository.all()
 
+    # served right away, the files are checked off the startup path
     for video in videos:
-        if not Path(video.path).exists():
-            continue
+        video_manager.add_video(Path(video.faststart_path or video.path), video.id)
+    run_in_background(verify_videos(videos))
+
 
-        video_manager.add_route(Path(video.path), video.id)
+@nonebot.get_driver().on_shutdown
+async def on_shutdown():
+    await download_pipeline.stop()
+    await save_watermarks()
+    if video_manager.cache is not None:
+        logger.info(f"Video chunk cache stats: {video_manager.cache.stats()}")
+    await close_session()
+    await torrent_downloader.close()
+    await storage_manager.flush_access()
+    await database.close()
+    faststart_executor.shutdown(wait=False)
 
 
 @nonebot.get_driver().on_startup
@@ -257,6 +935,21 @@ async def on_startup():
         raise RuntimeError("nonebot_plugin_anime_downloader only supports ASGI driver.")
 
 
+async def search_online(tags: List[str]) -> List[Dict[str, str]]:
+    anime_data = await get_anime_data(tags, plugin_config.acgrip_url)
+    # stored for local searches and /anmd, the reply doesn't wait for it
+    run_in_background(acgrip_repository.add_all(anime_data))
+    return anime_data
+
+
+search_cache: SearchCache[List[Dict[str, str]]] = SearchCache(
+    search_online,
+    plugin_config.acgrip_search_cache_size,
+    plugin_config.acgrip_search_cache_ttl,
+    plugin_config.acgrip_search_cache_stale,
+)
+
+
 async def get_target(event: Event) -> Target:
     return UniMessage.get_target(event)
 
@@ -270,6 +963,7 @@ search = on_command(
 download = on_command(
     "anmd", aliases={"番剧下载", "下载番剧", "下番", "animedownload"}, priority=5
 )
+traces = on_command("anmtrace", aliases={"番剧耗时"}, permission=SUPERUSER, priority=5)
 
 
 @subscribes.handle()
@@ -285,18 +979,16 @@ async def sub_handle(target: Target = Depends(get_target), arg: Message = Comman
     # check if the user is already subscribed the same tag
     id_ = f"{'private' if target.private else 'group'}_{target.id}"
 
-    user = user_session.query(User).filter_by(id=id_).first()
-    if user is not None:
-        tags_str = user.tags
-        tags_list: List[List[str]] = json.loads(tags_str)
+    tags_list = await user_repository.get_tags(id_)
+    if tags_list is not None:
         for tags in tags_list:
             if tags == args:
                 await subscribes.finish("您已经订阅了这个 Tag！")
         tags_list.append(args)
-        user.tags = json.dumps(tags_list, ensure_ascii=False)
     else:
-        user_session.add(User(id=id_, tags=json.dumps([args], ensure_ascii=False)))
-    user_session.commit()
+        tags_list = [args]
+    await user_repository.set_tags(id_, tags_list)
+    subscription_matcher.add(id_, args)
     await subscribes.finish("订阅成功！")
 
 
@@ -310,16 +1002,14 @@ async def unsub_handle(
         await unsubscribes.finish("请提供 Tag！")
 
     id_ = f"{'private' if target.private else 'group'}_{target.id}"
-    user = user_session.query(User).filter_by(id=id_).first()
-    if user is None:
+    tags_list = await user_repository.get_tags(id_)
+    if tags_list is None:
         await unsubscribes.finish("您还没有订阅任何 Tag！")
-    tags_str = user.tags
-    tags_list: List[List[str]] = json.loads(tags_str)
     for tags in tags_list:
         if tags == args:
             tags_list.remove(args)
-            user.tags = json.dumps(tags_list, ensure_ascii=False)
-            user_session.commit()
+            await user_repository.set_tags(id_, tags_list)
+            subscription_matcher.remove(id_, args)
             await unsubscribes.finish("取消订阅成功！")
     await unsubscribes.finish("您没有订阅这个 Tag！")
 
@@ -327,11 +1017,9 @@ async def unsub_handle(
 @list_subscribes.handle()
 async def list_sub_handle(target: Target = Depends(get_target)):
     id_ = f"{'private' if target.private else 'group'}_{target.id}"
-    user = user_session.query(User).filter_by(id=id_).first()
-    if user is None:
+    tags_list = await user_repository.get_tags(id_)
+    if tags_list is None:
         await list_subscribes.finish("您还没有订阅任何 Tag！")
-    tags_str = user.tags
-    tags_list: List[List[str]] = json.loads(tags_str)
     msg = "您订阅的 Tag 有：\n"
     for index, tags in enumerate(tags_list):
         msg += f"{index + 1}. {' '.join(tags)}\n"
@@ -348,7 +1036,15 @@ async def search_handle(arg: Message = CommandArg()):
     if tags == []:
         await search.finish("请提供搜索关键词！")
 
-    anime_data = await get_anime_data(tags, plugin_config.acgrip_url)
+    anime_data = await acgrip_repository.search(tags)
+
+    if len(anime_data) >= plugin_config.acgrip_search_min_results:
+        msg = ""
+        for entry in anime_data:
+            msg += f"{entry['id']}. {entry['title']}\n"
+        await search.finish(msg.strip())
+
+    anime_data = await search_cache.get(tags)
 
     if anime_data == []:
         await search.finish("没有找到相关番剧！")
@@ -359,16 +1055,6 @@ async def search_handle(arg: Message = CommandArg()):
 
     await search.send(msg.strip())
 
-    # store the data
-    for entry in anime_data:
-        existing_entry = (
-            acgrip_session.query(ACGRIPData).filter_by(id=entry["id"]).first()
-        )
-        if existing_entry is None:
-            acgrip_session.add(ACGRIPData(**entry))
-
-    acgrip_session.commit()
-
 
 @download.handle()
 async def download_handle(
@@ -382,45 +1068,63 @@ async def download_handle(
     if len(args) != 1:
         await download.finish("请提供正确的资源 ID！")
 
-    anime_entry = acgrip_session.query(ACGRIPData).filter_by(id=args[0]).first()
-
-    if anime_entry is None:
-        await download.finish("没有找到相关番剧，请使用搜索功能（/anmsc）获得资源 ID")
-
     torrent_id = args[0]
 
     if not torrent_id.isdigit():
         await download.finish("请提供正确的资源 ID！")
 
-    if int(torrent_id) in video_manager.ids:
-        await download.finish(
-            f"{anime_entry.title} 已存在！\n"
-            + f"{plugin_config.anime_url}:{nonebot.get_driver().config.port}/anime/{torrent_id}"
-        )
+    anime_entry = await acgrip_repository.get(int(torrent_id))
+
+    if anime_entry is None:
+        await download.finish("没有找到相关番剧，请使用搜索功能（/anmsc）获得资源 ID")
+
+    videos = [
+        video
+        for video in await video_repository.get_by_torrent(int(torrent_id))
+        if video.id in video_manager
+    ]
+    if videos:
+        await download.finish(f"{anime_entry.title} 已存在！\n" + get_video_links(videos))
 
     id_ = f"{'private' if target.private else 'group'}_{target.id}"
 
     tags = extract_tags_from_title(anime_entry.title)
 
-    torrent_data = await fetch_torrent_data(
-        f"{plugin_config.acgrip_url}/t/{torrent_id}.torrent"
-    )
+    queued = task_manager.find(int(torrent_id)) is not None
     try:
-        torrent_info = await torrent_downloader.download_torrent(
-            torrent_data, generate_folder_name(tags)
+        await download_for_users(
+            anime_entry.title,
+            int(torrent_id),
+            f"{plugin_config.acgrip_url}/t/{torrent_id}.torrent",
+            generate_folder_name(tags),
+            [id_],
         )
     except TorrentExistsError:
         await download.finish("任务已处于下载队列中")
     except Exception as e:
         await download.finish(f"下载失败！请稍后重试。\n{type(e).__name__}: {e}")
 
-    task_manager.add(
-        {
-            "id": id_,
-            "content": torrent_info,
-            "torrent_id": int(torrent_id),
-            "status": "downloading",
-        }
-    )
+    if queued:
+        await download.finish("任务已处于下载队列中，下载完成后会通知您")
 
     await download.send(f"开始下载 {anime_entry.title}...")
+
+
+@traces.handle()
+async def traces_handle(arg: Message = CommandArg()):
+    if not tracer.enabled:
+        await traces.finish("未启用耗时记录！请设置 ANIME_TRACING=true")
+
+    recent = list(reversed(tracer.traces))
+    if recent == []:
+        await traces.finish("还没有耗时记录！")
+
+    index = arg.extract_plain_text().strip()
+    if index == "":
+        msg = "\n".join(f"{i + 1}. {trace.summary()}" for i, trace in enumerate(recent))
+        await traces.finish(f"{msg}\n使用 /anmtrace <序号> 查看各阶段耗时")
+
+    if not index.isdigit() or not 1 <= int(index) <= len(recent):
+        await traces.finish("请提供正确的序号！")
+
+    await traces.finish(recent[int(index) - 1].render())
@@ -1,8 +1,13 @@
 import re
+import time
 import aiohttp
 import asyncio
+import codecs
 import urllib.parse
-from typing import List, Dict
+from typing import List, Dict, Optional
+
+from ..tracing import add_span
+from ..metrics import ACGRIP_PARSE_SECONDS, ACGRIP_REQUEST_SECONDS, timed
 
 
 headers = {
@@ -22,23 +27,267 @@ headers = {
 }
 
 
+TORRENT_LINK = re.compile(r'<a href="(https://[^\s]*/t/\d+|/t/\d+)"')
+TORRENT_FILE_LINK = re.compile(r'<a href=".*?\.torrent"', re.DOTALL)
+
+# states of a table row, in the order their parts appear in the markup
+OUTSIDE, SEEK_TITLE, TITLE, SEEK_ACTION, ACTION, SEEK_SIZE, SIZE, SEEK_END = range(8)
+
+# the markers each state is waiting for, nearest first; a new `<tr>` restarts the row
+MARKERS = {
+    OUTSIDE: ("<tr>",),
+    SEEK_TITLE: ('<time datetime="', '<a href="', "<tr>"),
+    TITLE: ("</a>",),
+    SEEK_ACTION: ('<td class="action">', "<tr>"),
+    SEEK_SIZE: ('<td class="size">', "<tr>"),
+    SIZE: ("</td>",),
+    SEEK_END: ("</tr>", "<tr>"),
+}
+MARKER_OVERLAP = max(len(marker) for markers in MARKERS.values() for marker in markers) - 1
+
+_session: Optional[aiohttp.ClientSession] = None
+
+# url -> validators (ETag / Last-Modified) of the last successful response
+_validators: Dict[str, Dict[str, str]] = {}
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Get the shared client session, creating it on first use.
+
+    Connections are pooled and kept alive between polls, so DNS, TCP and TLS
+    setup is not paid on every request.
+
+    Returns:
+        The shared aiohttp client session.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            headers=headers,
+            connector=aiohttp.TCPConnector(
+                limit=16, ttl_dns_cache=300, keepalive_timeout=60
+            ),
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Close the shared client session, if it was ever created."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
 async def make_request(arg: str = "", base_url: str = "https://acgrip.art") -> str:
     url = f"{base_url}/{arg}"
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(url) as response:
-            response_text = await response.text()
-            return response_text
+    async with get_session().get(url) as response:
+        response_text = await response.text()
+        return response_text
+
 
+@timed(ACGRIP_REQUEST_SECONDS, function="fetch_data")
+async def fetch_data(
+    arg: str = "", base_url: str = "https://acgrip.art", conditional: bool = False
+) -> Optional[List[Dict[str, str]]]:
+    """Request a page and extract its torrent entries while it downloads.
 
+    Args:
+        arg: The path and query to request.
+        base_url: The base URL of ACG.RIP.
+        conditional: Whether to revalidate the page against the last response.
+
+    Returns:
+        The torrent entries in the same format as `extract_data`, or None if
+        the request was conditional and the page has not been modified.
+    """
+    url = f"{base_url}/{arg}"
+    request_headers = {}
+    validators = _validators.get(url, {}) if conditional else {}
+    if "ETag" in validators:
+        request_headers["If-None-Match"] = validators["ETag"]
+    if "Last-Modified" in validators:
+        request_headers["If-Modified-Since"] = validators["Last-Modified"]
+
+    async with get_session().get(url, headers=request_headers) as response:
+        if response.status == 304:
+            return None
+
+        parser = ACGRIPParser()
+        decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(
+            errors="replace"
+        )
+        data = []
+        # parsing is interleaved with the download, so it is timed on its own
+        parse_time = 0.0
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            start = time.perf_counter()
+            data += parser.feed(decoder.decode(chunk))
+            parse_time += time.perf_counter() - start
+        start = time.perf_counter()
+        data += parser.feed(decoder.decode(b"", final=True))
+        data += parser.close()
+        parse_time += time.perf_counter() - start
+        ACGRIP_PARSE_SECONDS.observe(parse_time, function="fetch_data")
+        add_span("parse", parse_time)
+
+        if conditional and response.status == 200:
+            _validators[url] = {
+                key: response.headers[key]
+                for key in ("ETag", "Last-Modified")
+                if key in response.headers
+            }
+        return data
+
+
+@timed(ACGRIP_REQUEST_SECONDS, function="fetch_torrent_data")
 async def fetch_torrent_data(url: str) -> bytes:
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(url) as response:
-            torrent_data = await response.read()
-            return torrent_data
+    async with get_session().get(url) as response:
+        torrent_data = await response.read()
+        return torrent_data
+
+
+class ACGRIPParser:
+    """Incremental extractor of torrent entries from ACG.RIP HTML.
+
+    Markup is fed in chunks of any size. Each row is a small state machine that
+    jumps straight to the next marker it is waiting for with `str.find`, so the
+    page is scanned in linear time without backtracking, and finished entries
+    are returned as soon as their closing `</tr>` arrives. Apart from the
+    release time, the output is the same as running the original regular
+    expression over the entity-replaced page.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._state = OUTSIDE
+        self._parts: List[str] = []
+        self._url = ""
+        self._title = ""
+        self._size = ""
+        self._time = ""
+
+    def feed(self, data: str) -> List[Dict[str, str]]:
+        """Feed a chunk of HTML.
+
+        Args:
+          data: The next chunk of the page.
+
+        Returns:
+          The entries completed by this chunk.
+        """
+        entries: List[Dict[str, str]] = []
+        buffer = self._buffer + data
+        pos = 0
+
+        while True:
+            state = self._state
+
+            if state == ACTION:
+                # the download link has to follow `<td class="action">` directly
+                end = buffer.find(">", pos)
+                if end == -1:
+                    break
+                if TORRENT_FILE_LINK.match(buffer[pos : end + 1]):
+                    self._state = SEEK_SIZE
+                    pos = end + 1
+                else:
+                    self._state = SEEK_ACTION
+                continue
+
+            index, marker = -1, ""
+            for candidate in MARKERS[state]:
+                # only a marker before the nearest one found so far matters
+                end = len(buffer) if index == -1 else index + len(candidate) - 1
+                found = buffer.find(candidate, pos, end)
+                if found != -1:
+                    index, marker = found, candidate
+
+            if index == -1:
+                # keep enough of the tail to find a marker split across chunks
+                cut = max(pos, len(buffer) - MARKER_OVERLAP)
+                if state in (TITLE, SIZE):
+                    self._parts.append(buffer[pos:cut])
+                pos = cut
+                break
+
+            if state in (TITLE, SIZE):
+                self._parts.append(buffer[pos:index])
+
+            if marker == "<tr>":
+                self._state = SEEK_TITLE
+                self._time = ""
+                pos = index + 4
+            elif marker == '<time datetime="':
+                # the release time sits in the date column, before the title
+                start = index + len(marker)
+                end = buffer.find('"', start)
+                if end == -1:
+                    pos = index
+                    break
+                self._time = buffer[start:end]
+                pos = end + 1
+            elif state == SEEK_TITLE:
+                end = buffer.find(">", index)
+                if end == -1:
+                    pos = index
+                    break
+                match = TORRENT_LINK.match(buffer[index : end + 1])
+                if match is not None:
+                    self._url = match.group(1)
+                    self._parts = []
+                    self._state = TITLE
+                    pos = end + 1
+                else:
+                    pos = index + len(marker)
+            elif state == TITLE:
+                self._title = "".join(self._parts)
+                self._state = SEEK_ACTION
+                pos = index + len(marker)
+            elif state == SEEK_SIZE:
+                self._parts = []
+                self._state = SIZE
+                pos = index + len(marker)
+            elif state == SIZE:
+                self._size = "".join(self._parts)
+                self._state = SEEK_END
+                pos = index + len(marker)
+            elif state == SEEK_END:
+                # entities are decoded per field instead of over the whole page
+                url = replace_html_entities(self._url)
+                entries.append(
+                    {
+                        "title": replace_html_entities(self._title).strip(),
+                        "url": url,
+                        "id": url.split("/")[-1],
+                        "size": replace_html_entities(self._size).strip(),
+                        "time": self._time,
+                    }
+                )
+                self._state = OUTSIDE
+                pos = index + len(marker)
+            else:
+                self._state = ACTION
+                pos = index + len(marker)
+
+        self._buffer = buffer[pos:]
+        return entries
+
+    def close(self) -> List[Dict[str, str]]:
+        """Flush the parser at the end of the page.
+
+        Returns:
+          The entries completed by the remaining input.
+        """
+        entries = self.feed("")
+        self._buffer = ""
+        return entries
 
 
 def extract_data(html_content: str) -> List[Dict[str, str]]:
-    """Extracts title, URL, ID, and size from ACG.RIP HTML content.
+    """Extracts title, URL, ID, size and release time from ACG.RIP HTML content.
+
+    HTML entities are decoded per field, so pass the page as it was received.
 
     Args:
       html_content: The HTML content as a string.
@@ -50,25 +299,13 @@ def extract_data(html_content: str) -> List[Dict[str, str]]:
         "title": "[桜都字幕组] ... [简繁内封]",
         "url": "/t/302390",
         "id": "302390",
-        "size": "99.8 MB"
+        "size": "99.8 MB",
+        "time": "1714000000"  # unix time, empty if the row has none
       }
     """
-
-    # Regular expression to match torrent entries
-    pattern = r'<tr>.*?<a href="(https://[^\s]*/t/\d+|/t/\d+)".*?>(.*?)</a>.*?<td class="action"><a href=".*?\.torrent".*?>.*?</td>.*?<td class="size">(.*?)</td>.*?</tr>'
-
-    # Find all matches in the HTML content
-    matches = re.findall(pattern, html_content, re.DOTALL)
-
-    # Extract data and create a list of dictionaries
-    data = []
-    for match in matches:
-        url, title, size = match
-        id_ = url.split("/")[-1]  # Extract ID from URL
-        data.append(
-            {"title": title.strip(), "url": url, "id": id_, "size": size.strip()}
-        )
-
+    parser = ACGRIPParser()
+    data = parser.feed(html_content)
+    data += parser.close()
     return data
 
 
@@ -143,24 +380,36 @@ async def get_anime_data(tags: List[str], base_url: str) -> List[Dict[str, str]]
         "title": "[桜都字幕组] ... [简繁内封]",
         "url": "/t/302390",
         "id": "302390",
-        "size": "99.8 MB"
+        "size": "99.8 MB",
+        "time": "1714000000"  # unix time, empty if the row has none
       }
     """
     query = convert_tags_to_query(tags)
-    html = await make_request(f"?term={query}", base_url)
-    html = replace_html_entities(html)
-    data = extract_data(html)
+    data = await fetch_data(f"?term={query}", base_url)
+    return data
+
+
+async def get_page_data(page: int, base_url: str) -> List[Dict[str, str]]:
+    """Fetches one page of the ACG.RIP index.
+
+    Args:
+      page: The page number, starting from 1.
+      base_url: The base URL of ACG.RIP.
+
+    Returns:
+      A list of torrent entries, in the same format as `extract_data`.
+    """
+    data = await fetch_data(f"page/{page}" if page > 1 else "", base_url)
     return data
 
 
 async def main() -> None:
     tag = ["北宇治字幕组", "GIRLS BAND CRY", "简体内嵌"]
-    html = await make_request(f"?term={convert_tags_to_query(tag)}")
-
-    html = replace_html_entities(html)
-    data = extract_data(html)
+    data = await fetch_data(f"?term={convert_tags_to_query(tag)}")
     print(data)
 
+    await close_session()
+
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
@@ -1,18 +1,71 @@
+from typing import Dict
+
 from pydantic import BaseModel
 
 
+DEFAULT_PIPELINE_WORKERS = {"match": 1, "fetch": 4, "add": 2, "record": 1}
+
+
 class Config(BaseModel):
     anime_url: str = "http://127.0.0.1"
     """你的服务器公网地址，用于提供视频观看链接"""
+    anime_cache_size: int = 256
+    """视频分块缓存的内存上限（MB），为 0 时不缓存"""
+    anime_streaming: bool = False
+    """是否启用边下边播，启用后按顺序下载种子，并在开头部分下载完成后提前发送观看链接"""
+    anime_streaming_buffer: int = 16
+    """边下边播时，视频开头下载多少 MB 后发送观看链接"""
+    anime_faststart: bool = True
+    """下载完成后是否将 MP4 的 moov 移到文件开头，以加快网页播放器的起播"""
+    anime_storage_quota: float = 0
+    """下载目录占用空间的上限（GB），超出后删除最久没有观看的番剧，为 0 时不限制"""
+    anime_storage_low_watermark: float = 0.9
+    """超出上限后，删除到占用空间低于上限的该比例为止"""
+    anime_metrics: bool = False
+    """是否在 /anime_downloader/metrics 提供 Prometheus 格式的监控指标"""
+    anime_tracing: bool = False
+    """是否记录定时任务每次运行中各阶段的耗时，供超级用户通过 /anmtrace 查看"""
+    anime_tracing_size: int = 20
+    """保留最近多少次运行的耗时记录"""
+    anime_profile_threshold: float = 0
+    """启用耗时记录后，被抽样的运行超过该耗时（秒）时保存 cProfile 结果，为 0 时不抽样"""
+    anime_profile_sample_rate: float = 0.1
+    """用 cProfile 抽样的运行所占比例"""
     acgrip_url: str = "https://acgrip.art"
     """ACG.RIP 的 URL"""
     acgrip_interval: int = 600
     """从 ACG.RIP 获取种子数据的时间间隔（秒）"""
+    acgrip_adaptive: bool = False
+    """是否根据历史发布时间自动调整轮询间隔，启用后 acgrip_interval 仅在尚无历史数据时使用"""
+    acgrip_min_interval: int = 60
+    """自动调整时，发布高峰期的轮询间隔（秒）"""
+    acgrip_max_interval: int = 1800
+    """自动调整时，没有发布的时段的轮询间隔（秒）"""
+    acgrip_catch_up_pages: int = 10
+    """轮询时最多向后翻阅的 ACG.RIP 页数，用于补上停机期间错过的种子"""
+    acgrip_search_min_results: int = 5
+    """本地搜索结果少于该数量时才会在 ACG.RIP 上搜索"""
+    acgrip_search_cache_size: int = 128
+    """缓存最近多少个 ACG.RIP 搜索的结果"""
+    acgrip_search_cache_ttl: int = 300
+    """ACG.RIP 搜索结果直接使用缓存的时间（秒），为 0 时不缓存"""
+    acgrip_search_cache_stale: int = 3600
+    """缓存过期后仍可先返回旧结果、同时在后台刷新的时间（秒）"""
     qbittorrent_host: str = "localhost:8080"
     """qBittorrent WebUI 的地址"""
     qbittorrent_username: str = "admin"
     """qBittorrent WebUI 的用户名"""
     qbittorrent_password: str = "adminadmin"
     """qBittorrent WebUI 的密码"""
+    qbittorrent_webhook_token: str = ""
+    """qBittorrent 下载完成回调的令牌，留空则不启用回调"""
+    pipeline_workers: Dict[str, int] = DEFAULT_PIPELINE_WORKERS
+    """下载流水线各阶段（match/fetch/add/record）同时处理的数量"""
+    pipeline_timeout: int = 60
+    """下载流水线中每一项在每个阶段单次尝试的超时时间（秒）"""
+    pipeline_retries: int = 3
+    """下载流水线中每一项在每个阶段失败后的最大重试次数，重试间隔按指数增长并带随机抖动"""
+    task_reconcile_interval: int = 600
+    """启用回调后，轮询下载任务状态的时间间隔（秒）"""
     download_path: str = "/downloads"
     """种子下载到的路径"""
@@ -1,31 +1,253 @@
-from sqlalchemy import Column, Integer, String
+from pathlib import Path
+from typing import Dict, List
+from sqlalchemy.engine import Connection
+from sqlalchemy import Column, Integer, String, text
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 
+from .utils import normalize_text
 
-ACGRIPBase = declarative_base()
-UserBase = declarative_base()
-VideoBase = declarative_base()
 
+Base = declarative_base()
 
-class ACGRIPData(ACGRIPBase):
+
+class ACGRIPData(Base):
     __tablename__ = "acgrip"
 
     id = Column(Integer, primary_key=True)
     title = Column(String)
     url = Column(String)
     size = Column(String)
+    normalized_title = Column(String)  # simplified Chinese, lowercased
+    time = Column(Integer, index=True)  # unix time of the release
 
 
-class User(UserBase):
+class User(Base):
     __tablename__ = "users"
 
     id = Column(String, primary_key=True) # group/private_id
     tags = Column(String) # json : list[list[str]]
 
 
-class Video(VideoBase):
+class State(Base):
+    __tablename__ = "state"
+
+    key = Column(String, primary_key=True)
+    value = Column(Integer)
+
+
+class Video(Base):
     __tablename__ = "videos"
 
-    id = Column(Integer, primary_key=True)
-    title = Column(String)
+    id = Column(Integer, primary_key=True) # equals torrent_id for videos of older versions
+    torrent_id = Column(Integer, index=True)
+    episode = Column(String) # file name without suffix
+    title = Column(String) # torrent name
     path = Column(String)
+    faststart_path = Column(String) # copy with moov moved to the front, if rewritten
+    torrent_hash = Column(String) # hash of the torrent in qBittorrent, unknown for older versions
+    last_access = Column(Integer) # unix time the video was last requested, or cataloged
+
+
+# trigram tokens make FTS5 match arbitrary substrings, which is what tags are
+FTS_MIN_TAG_LENGTH = 3
+
+
+def merge_legacy_databases(conn: Connection, legacy_files: Dict[str, Path]) -> None:
+    """Copy the tables of the per-table databases of older versions.
+
+    Each legacy file is renamed to `*.migrated` once its rows are copied, so
+    the merge runs only once.
+
+    Args:
+        conn: A connection to the merged database.
+        legacy_files: A dict mapping table names to their legacy database files.
+    """
+    for table, file in legacy_files.items():
+        if not file.exists():
+            continue
+
+        conn.exec_driver_sql("ATTACH DATABASE ? AS legacy", (str(file.resolve()),))
+        try:
+            legacy_columns = {
+                row[1]
+                for row in conn.exec_driver_sql(f"PRAGMA legacy.table_info({table})")
+            }
+            columns = ", ".join(
+                column.name
+                for column in Base.metadata.tables[table].columns
+                if column.name in legacy_columns
+            )
+            if columns:
+                conn.exec_driver_sql(
+                    f"INSERT OR IGNORE INTO main.{table} ({columns}) "
+                    f"SELECT {columns} FROM legacy.{table}"
+                )
+            conn.commit()
+        finally:
+            conn.exec_driver_sql("DETACH DATABASE legacy")
+
+        file.rename(file.with_name(f"{file.name}.migrated"))
+
+
+def migrate_acgrip(conn: Connection) -> None:
+    """Add the normalized title and time columns and the FTS5 index to the acgrip table.
+
+    Existing titles are backfilled, so databases created by older versions can
+    be searched locally as well. Their release times are unknown and stay NULL.
+
+    Args:
+        conn: A connection to the database.
+    """
+    columns = [row[1] for row in conn.execute(text("PRAGMA table_info(acgrip)"))]
+    if "normalized_title" not in columns:
+        conn.execute(text("ALTER TABLE acgrip ADD COLUMN normalized_title VARCHAR"))
+    if "time" not in columns:
+        conn.execute(text("ALTER TABLE acgrip ADD COLUMN time INTEGER"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_acgrip_time ON acgrip (time)"))
+
+    rows = conn.execute(
+        text("SELECT id, title FROM acgrip WHERE normalized_title IS NULL")
+    ).fetchall()
+    if rows:
+        conn.execute(
+            text("UPDATE acgrip SET normalized_title = :normalized WHERE id = :id"),
+            [
+                {"id": row[0], "normalized": normalize_text(row[1] or "")}
+                for row in rows
+            ],
+        )
+
+    exists = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = 'acgrip_fts'")
+    ).first()
+    if exists is not None:
+        return None
+
+    try:
+        conn.execute(
+            text(
+                "CREATE VIRTUAL TABLE acgrip_fts USING fts5("
+                "normalized_title, content='acgrip', content_rowid='id', "
+                "tokenize='trigram')"
+            )
+        )
+    except OperationalError:
+        # SQLite < 3.34 has no trigram tokenizer, search falls back to LIKE
+        return None
+
+    conn.execute(
+        text(
+            "CREATE TRIGGER acgrip_fts_insert AFTER INSERT ON acgrip BEGIN "
+            "INSERT INTO acgrip_fts(rowid, normalized_title) "
+            "VALUES (new.id, new.normalized_title); END"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE TRIGGER acgrip_fts_delete AFTER DELETE ON acgrip BEGIN "
+            "INSERT INTO acgrip_fts(acgrip_fts, rowid, normalized_title) "
+            "VALUES ('delete', old.id, old.normalized_title); END"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE TRIGGER acgrip_fts_update AFTER UPDATE ON acgrip BEGIN "
+            "INSERT INTO acgrip_fts(acgrip_fts, rowid, normalized_title) "
+            "VALUES ('delete', old.id, old.normalized_title); "
+            "INSERT INTO acgrip_fts(rowid, normalized_title) "
+            "VALUES (new.id, new.normalized_title); END"
+        )
+    )
+    conn.execute(text("INSERT INTO acgrip_fts(acgrip_fts) VALUES ('rebuild')"))
+
+
+def migrate_videos(conn: Connection) -> None:
+    """Add the columns of newer versions to the videos table.
+
+    Older versions stored one video per torrent under the torrent id, so
+    their rows keep serving under the same id.
+
+    Args:
+        conn: A connection to the database.
+    """
+    columns = [row[1] for row in conn.execute(text("PRAGMA table_info(videos)"))]
+    if "torrent_id" not in columns:
+        conn.execute(text("ALTER TABLE videos ADD COLUMN torrent_id INTEGER"))
+    if "episode" not in columns:
+        conn.execute(text("ALTER TABLE videos ADD COLUMN episode VARCHAR"))
+    if "faststart_path" not in columns:
+        conn.execute(text("ALTER TABLE videos ADD COLUMN faststart_path VARCHAR"))
+    if "torrent_hash" not in columns:
+        conn.execute(text("ALTER TABLE videos ADD COLUMN torrent_hash VARCHAR"))
+    if "last_access" not in columns:
+        conn.execute(text("ALTER TABLE videos ADD COLUMN last_access INTEGER"))
+
+    conn.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_videos_torrent_id ON videos (torrent_id)")
+    )
+    conn.execute(text("UPDATE videos SET torrent_id = id WHERE torrent_id IS NULL"))
+
+    rows = conn.execute(
+        text("SELECT id, path FROM videos WHERE episode IS NULL")
+    ).fetchall()
+    if rows:
+        conn.execute(
+            text("UPDATE videos SET episode = :episode WHERE id = :id"),
+            [
+                # older versions joined paths with a backslash on every platform
+                {"id": row[0], "episode": Path((row[1] or "").replace("\\", "/")).stem}
+                for row in rows
+            ],
+        )
+
+
+def search_acgrip(conn: Connection, tags: List[str], limit: int = 50) -> List[Dict[str, str]]:
+    """Search the stored ACG.RIP entries whose titles contain all tags.
+
+    Args:
+        conn: A connection to the database.
+        tags: A list of tags to search for.
+        limit: The maximum number of entries to return, newest first.
+
+    Returns:
+        A list of entries in the same format as `acgrip.extract_data`.
+    """
+    tags = [tag for tag in map(normalize_text, tags) if tag]
+    if not tags:
+        return []
+
+    has_fts = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = 'acgrip_fts'")
+    ).first()
+
+    conditions = []
+    params: Dict[str, str] = {}
+    fts_terms = []
+    for index, tag in enumerate(tags):
+        if has_fts and len(tag) >= FTS_MIN_TAG_LENGTH:
+            fts_terms.append('"' + tag.replace('"', '""') + '"')
+        else:
+            escaped = tag.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append(f"normalized_title LIKE :tag{index} ESCAPE '\\'")
+            params[f"tag{index}"] = f"%{escaped}%"
+
+    if fts_terms:
+        conditions.append(
+            "id IN (SELECT rowid FROM acgrip_fts WHERE acgrip_fts MATCH :query)"
+        )
+        params["query"] = " AND ".join(fts_terms)
+
+    rows = conn.execute(
+        text(
+            "SELECT id, title, url, size FROM acgrip WHERE "
+            + " AND ".join(conditions)
+            + f" ORDER BY id DESC LIMIT {int(limit)}"
+        ),
+        params,
+    ).fetchall()
+
+    return [
+        {"title": row[1], "url": row[2], "id": str(row[0]), "size": row[3]}
+        for row in rows
+    ]
@@ -0,0 +1,300 @@
+import json
+import time
+from pathlib import Path
+from sqlalchemy import bindparam, delete, event, func, select, update
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+from .utils import normalize_text
+from .metrics import SQLITE_QUERY_SECONDS
+from .data_source import (
+    Base,
+    User,
+    State,
+    Video,
+    ACGRIPData,
+    search_acgrip,
+    migrate_acgrip,
+    migrate_videos,
+    merge_legacy_databases,
+)
+
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",  # 16 MiB
+    "PRAGMA mmap_size = 268435456",  # 256 MiB
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+class Database:
+    """The plugin's single SQLite database, accessed through aiosqlite.
+
+    WAL mode lets the scheduler write while handlers and video routes read,
+    and no query blocks the event loop.
+    """
+
+    def __init__(self, db_file: Path) -> None:
+        self.engine: AsyncEngine = create_async_engine(
+            f"sqlite+aiosqlite:///{db_file.resolve()}"
+        )
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+        @event.listens_for(self.engine.sync_engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in PRAGMAS:
+                cursor.execute(pragma)
+            cursor.close()
+
+        # fired on the thread of aiosqlite; a connection runs one statement at a time
+        @event.listens_for(self.engine.sync_engine, "before_cursor_execute")
+        def start_timer(conn, cursor, statement, parameters, context, executemany):
+            conn.info["query_start"] = time.perf_counter()
+
+        @event.listens_for(self.engine.sync_engine, "after_cursor_execute")
+        def stop_timer(conn, cursor, statement, parameters, context, executemany):
+            SQLITE_QUERY_SECONDS.observe(time.perf_counter() - conn.info["query_start"])
+
+    async def init(self, legacy_files: Dict[str, Path]) -> None:
+        """Create the tables and migrate data written by older versions.
+
+        Args:
+            legacy_files: A dict mapping table names to the separate database
+                files older versions kept them in.
+        """
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(migrate_acgrip)
+            await conn.run_sync(migrate_videos)
+
+        async with self.engine.connect() as conn:
+            await conn.run_sync(merge_legacy_databases, legacy_files)
+
+        async with self.engine.begin() as conn:
+            # backfill the rows merged from legacy acgrip.db and videos.db
+            await conn.run_sync(migrate_acgrip)
+            await conn.run_sync(migrate_videos)
+
+    async def close(self) -> None:
+        await self.engine.dispose()
+
+
+class ACGRIPRepository:
+    def __init__(self, database: Database) -> None:
+        self.sessionmaker = database.sessionmaker
+
+    async def get(self, id_: int) -> Optional[ACGRIPData]:
+        async with self.sessionmaker() as session:
+            return await session.get(ACGRIPData, id_)
+
+    async def max_id(self) -> Optional[int]:
+        async with self.sessionmaker() as session:
+            return await session.scalar(select(func.max(ACGRIPData.id)))
+
+    async def add_all(self, entries: List[Dict[str, str]]) -> None:
+        """Store entries in one statement, skipping ids that are already stored.
+
+        Args:
+            entries: A list of entries in the format of `acgrip.extract_data`.
+        """
+        if not entries:
+            return None
+
+        async with self.sessionmaker() as session:
+            await session.execute(
+                insert(ACGRIPData).on_conflict_do_nothing(),
+                [
+                    {
+                        **entry,
+                        "normalized_title": normalize_text(entry["title"]),
+                        "time": (
+                            int(entry["time"]) if entry.get("time", "").isdigit() else None
+                        ),
+                    }
+                    for entry in entries
+                ],
+            )
+            await session.commit()
+
+    async def get_range(self, after: int, until: int) -> List[Dict[str, str]]:
+        """Get the entries with ids in `(after, until]`, oldest first.
+
+        Returns:
+            A list of entries in the same format as `acgrip.extract_data`.
+        """
+        async with self.sessionmaker() as session:
+            rows = await session.scalars(
+                select(ACGRIPData)
+                .where(ACGRIPData.id > after, ACGRIPData.id <= until)
+                .order_by(ACGRIPData.id)
+            )
+            return [
+                {
+                    "title": row.title,
+                    "url": row.url,
+                    "id": str(row.id),
+                    "size": row.size,
+                    "time": "" if row.time is None else str(row.time),
+                }
+                for row in rows
+            ]
+
+    async def release_times(self, since: int) -> List[Tuple[int, str]]:
+        """Get the release time and title of every entry released since a time.
+
+        Args:
+            since: A unix time.
+        """
+        async with self.sessionmaker() as session:
+            rows = await session.execute(
+                select(ACGRIPData.time, ACGRIPData.title).where(ACGRIPData.time >= since)
+            )
+            return [(row[0], row[1]) for row in rows]
+
+    async def search(self, tags: List[str], limit: int = 50) -> List[Dict[str, str]]:
+        async with self.sessionmaker() as session:
+            conn = await session.connection()
+            return await conn.run_sync(search_acgrip, tags, limit)
+
+
+class StateRepository:
+    """Integers the plugin keeps across restarts, like the poller's watermark."""
+
+    def __init__(self, database: Database) -> None:
+        self.sessionmaker = database.sessionmaker
+
+    async def get(self, key: str) -> Optional[int]:
+        async with self.sessionmaker() as session:
+            state = await session.get(State, key)
+            return None if state is None else state.value
+
+    async def set(self, values: Dict[str, int]) -> None:
+        async with self.sessionmaker() as session:
+            for key, value in values.items():
+                await session.merge(State(key=key, value=value))
+            await session.commit()
+
+
+class UserRepository:
+    def __init__(self, database: Database) -> None:
+        self.sessionmaker = database.sessionmaker
+
+    async def all(self) -> List[User]:
+        async with self.sessionmaker() as session:
+            return list(await session.scalars(select(User)))
+
+    async def get_tags(self, user_id: str) -> Optional[List[List[str]]]:
+        async with self.sessionmaker() as session:
+            user = await session.get(User, user_id)
+            return None if user is None else json.loads(user.tags)
+
+    async def set_tags(self, user_id: str, tags_list: List[List[str]]) -> None:
+        async with self.sessionmaker() as session:
+            await session.merge(
+                User(id=user_id, tags=json.dumps(tags_list, ensure_ascii=False))
+            )
+            await session.commit()
+
+
+class VideoRepository:
+    def __init__(self, database: Database) -> None:
+        self.sessionmaker = database.sessionmaker
+
+    async def all(self) -> List[Video]:
+        async with self.sessionmaker() as session:
+            return list(await session.scalars(select(Video)))
+
+    async def get(self, id_: int) -> Optional[Video]:
+        async with self.sessionmaker() as session:
+            return await session.get(Video, id_)
+
+    async def get_by_torrent(self, torrent_id: int) -> List[Video]:
+        async with self.sessionmaker() as session:
+            return list(
+                await session.scalars(
+                    select(Video).where(Video.torrent_id == torrent_id).order_by(Video.path)
+                )
+            )
+
+    async def add_torrent_videos(
+        self, torrent_id: int, title: str, paths: List[Path], torrent_hash: str
+    ) -> List[Video]:
+        """Store the video files of a torrent, each under its own id.
+
+        Files that are stored already keep their ids, so cataloging a torrent
+        again is harmless.
+
+        Args:
+            torrent_id: The ACG.RIP id of the torrent.
+            title: The name of the torrent.
+            paths: The paths of the video files.
+            torrent_hash: The hash of the torrent in qBittorrent.
+
+        Returns:
+            The videos of the given paths, in the same order.
+        """
+        async with self.sessionmaker() as session:
+            existing = {
+                video.path: video
+                for video in await session.scalars(
+                    select(Video).where(Video.torrent_id == torrent_id)
+                )
+            }
+            videos = []
+            for path in paths:
+                video = existing.get(str(path))
+                if video is None:
+                    video = Video(
+                        torrent_id=torrent_id,
+                        episode=path.stem,
+                        title=title,
+                        path=str(path),
+                        # a new episode is not the least recently watched
+                        last_access=int(time.time()),
+                    )
+                    session.add(video)
+                    existing[str(path)] = video
+                video.torrent_hash = torrent_hash
+                videos.append(video)
+            await session.commit()
+            return videos
+
+    async def set_faststart_path(self, id_: int, faststart_path: Path) -> None:
+        async with self.sessionmaker() as session:
+            video = await session.get(Video, id_)
+            if video is not None:
+                video.faststart_path = str(faststart_path)
+                await session.commit()
+
+    async def set_last_access(self, accesses: Dict[int, float]) -> None:
+        """Store when videos were last requested.
+
+        Args:
+            accesses: A dict mapping video ids to unix times.
+        """
+        if not accesses:
+            return None
+
+        async with self.sessionmaker() as session:
+            # on the table, as videos evicted meanwhile are no error
+            table = Video.__table__
+            await session.execute(
+                update(table)
+                .where(table.c.id == bindparam("video_id"))
+                .values(last_access=bindparam("accessed_at")),
+                [
+                    {"video_id": id_, "accessed_at": int(accessed_at)}
+                    for id_, accessed_at in accesses.items()
+                ],
+            )
+            await session.commit()
+
+    async def delete_by_torrent(self, torrent_id: int) -> None:
+        async with self.sessionmaker() as session:
+            await session.execute(delete(Video).where(Video.torrent_id == torrent_id))
+            await session.commit()
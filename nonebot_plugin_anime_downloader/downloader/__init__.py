@@ -1,56 +1,127 @@
-# https://qbittorrent-api.readthedocs.io/en/latest/apidoc/torrents.html
+# https://github.com/qbittorrent/qBittorrent/wiki/WebUI-API-(qBittorrent-4.1)
 
-import hashlib
-import binascii
-import torrent_parser
+import asyncio
 from pathlib import Path
-from qbittorrentapi import Client
-from nonebot.utils import run_sync
+from typing import Dict, List
 
-from .models import TorrentInfo
+from .models import TorrentFile, TorrentInfo
+from .client import QBittorrentClient
+from .bencode import get_info_hashes
 from .exceptions import TorrentExistsError, TorrentUnexistsError
+from ..metrics import QBITTORRENT_CALL_SECONDS, timed
 
 
 class TorrentDownloader:
     def __init__(self, host: str, username: str, password: str, download_path: Path):
-        self.client = Client(host=host, username=username, password=password)
+        self.client = QBittorrentClient(host=host, username=username, password=password)
         self.download_path = download_path
+        # torrents known from sync/maindata, updated incrementally with `_rid`
+        self._torrents: Dict[str, TorrentInfo] = {}
+        self._rid = 0
 
-    def _get_torrent_hash(self, torrent_file: bytes):
-        torrent = torrent_parser.TorrentFileParser(torrent_file, hash_raw=True).parse()
-        info_bytes = torrent_parser.encode(torrent["info"])
-        info_hash = binascii.hexlify(hashlib.sha1(info_bytes).digest()).decode()
-        return info_hash
+    def _get_torrent_hash(self, torrent_file: bytes) -> str:
+        return get_info_hashes(torrent_file).id
 
+    async def close(self) -> None:
+        await self.client.close()
+
+    @timed(QBITTORRENT_CALL_SECONDS, method="download_torrent")
     async def download_torrent(
-        self, torrent_file: bytes, folder_name: str
+        self, torrent_file: bytes, folder_name: str, sequential: bool = False
     ) -> TorrentInfo:
+        """Add a torrent to qBittorrent.
+
+        Args:
+            torrent_file: The content of the torrent file.
+            folder_name: The folder under the download path to save to.
+            sequential: Whether to download pieces in order, first and last
+                pieces first, so the video can be watched while downloading.
+
+        Returns:
+            The info of the added torrent.
+        """
         hash_str = self._get_torrent_hash(torrent_file)
 
         if (await self.is_torrent_exists(hash_str)):
             raise TorrentExistsError(f"Torrent with hash {hash_str} already exists.")
 
-        text = await run_sync(self.client.torrents_add)(
-            torrent_files=torrent_file, save_path=self.download_path / folder_name
+        text = await self.client.torrents_add(
+            torrent_file,
+            save_path=str(self.download_path / folder_name),
+            sequential=sequential,
         )
 
         if text == "Fails.":
             raise Exception("Failed to download torrent.")
 
-        await run_sync(self.client.torrents_reannounce)(torrent_hashes=hash_str)
-
-        torrent_info = (
-            await run_sync(self.client.torrents_info)(torrent_hashes=hash_str)
-        )[0]
+        _, torrents = await asyncio.gather(
+            self.client.torrents_reannounce([hash_str]),
+            self.client.torrents_info([hash_str]),
+        )
+        torrent_info = torrents[0]
 
         return torrent_info
 
+    @timed(QBITTORRENT_CALL_SECONDS, method="is_torrent_exists")
     async def is_torrent_exists(self, hash_str: str) -> bool:
-        torrents = await run_sync(self.client.torrents_info)(torrent_hashes=hash_str)
+        torrents = await self.client.torrents_info([hash_str])
         return torrents != []
 
+    @timed(QBITTORRENT_CALL_SECONDS, method="get_torrent_info")
     async def get_torrent_info(self, hash_str: str) -> TorrentInfo:
-        torrents = await run_sync(self.client.torrents_info)(torrent_hashes=hash_str)
+        torrents = await self.client.torrents_info([hash_str])
         if torrents == []:
             raise TorrentUnexistsError(f"Torrent with hash {hash_str} does not exist.")
         return torrents[0]
+
+    @timed(QBITTORRENT_CALL_SECONDS, method="get_torrents_info")
+    async def get_torrents_info(self, hashes: List[str]) -> Dict[str, TorrentInfo]:
+        if not hashes:
+            return {}
+        torrents = await self.client.torrents_info(hashes)
+        return {torrent["hash"]: torrent for torrent in torrents}
+
+    @timed(QBITTORRENT_CALL_SECONDS, method="get_torrent_files")
+    async def get_torrent_files(self, hash_str: str) -> List[TorrentFile]:
+        return await self.client.torrents_files(hash_str)
+
+    @timed(QBITTORRENT_CALL_SECONDS, method="get_piece_size")
+    async def get_piece_size(self, hash_str: str) -> int:
+        properties = await self.client.torrents_properties(hash_str)
+        return properties["piece_size"]
+
+    @timed(QBITTORRENT_CALL_SECONDS, method="get_piece_states")
+    async def get_piece_states(self, hash_str: str) -> List[int]:
+        """Get the state of every piece: 0 missing, 1 downloading, 2 downloaded."""
+        return await self.client.torrents_piece_states(hash_str)
+
+    @timed(QBITTORRENT_CALL_SECONDS, method="delete_torrent")
+    async def delete_torrent(self, hash_str: str, delete_files: bool = False) -> None:
+        """Remove a torrent from qBittorrent, and its downloaded files if `delete_files`."""
+        await self.client.torrents_delete([hash_str], delete_files)
+        self._torrents.pop(hash_str, None)
+
+    @timed(QBITTORRENT_CALL_SECONDS, method="sync_torrents")
+    async def sync_torrents(self) -> Dict[str, TorrentInfo]:
+        """Bring the local view of all torrents up to date.
+
+        Uses the incremental `sync/maindata` endpoint, so after the first call
+        only torrents that changed since the last one are transferred.
+
+        Returns:
+            A dict mapping info hashes to torrent info.
+        """
+        data = await self.client.sync_maindata(rid=self._rid)
+
+        if data.get("full_update"):
+            self._torrents = {}
+
+        for hash_str, changes in data.get("torrents", {}).items():
+            torrent = self._torrents.setdefault(hash_str, {"hash": hash_str})
+            torrent.update(changes)
+
+        for hash_str in data.get("torrents_removed", []):
+            self._torrents.pop(hash_str, None)
+
+        self._rid = data.get("rid", 0)
+        return self._torrents
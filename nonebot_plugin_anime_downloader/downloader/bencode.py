@@ -0,0 +1,100 @@
+# https://www.bittorrent.org/beps/bep_0003.html
+# https://www.bittorrent.org/beps/bep_0052.html
+
+import hashlib
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from .exceptions import InvalidTorrentError
+
+
+class InfoHashes(NamedTuple):
+    v1: Optional[str]  # sha1 of the info dict, for v1 and hybrid torrents
+    v2: Optional[str]  # sha256 of the info dict, for v2 and hybrid torrents
+
+    @property
+    def id(self) -> str:
+        """The hash qBittorrent identifies the torrent by."""
+        # v2-only torrents are identified by their truncated v2 hash
+        return self.v1 if self.v1 is not None else self.v2[:40]  # type: ignore
+
+
+def _skip_value(data: bytes, pos: int) -> int:
+    """Return the end of the bencoded value at `pos`, without decoding it.
+
+    Strings are skipped by their length prefix, so a piece table of any size
+    costs as much as a short string.
+    """
+    depth = 0
+    while True:
+        char = data[pos]
+        if char == 0x64 or char == 0x6C:  # d, l
+            depth += 1
+            pos += 1
+        elif char == 0x65:  # e
+            depth -= 1
+            pos += 1
+        elif char == 0x69:  # i
+            pos = data.index(b"e", pos) + 1
+        elif 0x30 <= char <= 0x39:  # string length
+            colon = data.index(b":", pos)
+            pos = colon + 1 + int(data[pos:colon])
+        else:
+            raise InvalidTorrentError(f"Unexpected byte {char:#x} at {pos}.")
+
+        if depth == 0:
+            return pos
+        if depth < 0:
+            raise InvalidTorrentError(f"Unexpected end of container at {pos - 1}.")
+
+
+def _read_dict_spans(data: bytes, pos: int) -> Tuple[Dict[bytes, Tuple[int, int]], int]:
+    """Read the keys of the bencoded dict at `pos` and the spans of their values."""
+    if data[pos] != 0x64:  # d
+        raise InvalidTorrentError(f"Expected a dict at {pos}.")
+
+    spans = {}
+    pos += 1
+    while data[pos] != 0x65:  # e
+        colon = data.index(b":", pos)
+        key_end = colon + 1 + int(data[pos:colon])
+        key = data[colon + 1 : key_end]
+        end = _skip_value(data, key_end)
+        spans[key] = (key_end, end)
+        pos = end
+    return spans, pos + 1
+
+
+def get_info_hashes(torrent_file: bytes) -> InfoHashes:
+    """Hash the raw info dict of a torrent file, without decoding the file.
+
+    Args:
+        torrent_file: The content of the torrent file.
+
+    Returns:
+        The v1 and v2 info hashes, of which hybrid torrents have both.
+
+    Raises:
+        InvalidTorrentError: If the data is not a torrent file.
+    """
+    try:
+        root, _ = _read_dict_spans(torrent_file, 0)
+        if b"info" not in root:
+            raise InvalidTorrentError("The torrent has no info dict.")
+        start, end = root[b"info"]
+        info, _ = _read_dict_spans(torrent_file, start)
+    except (IndexError, ValueError) as e:
+        raise InvalidTorrentError(f"Malformed torrent file: {e}") from e
+
+    info_bytes = memoryview(torrent_file)[start:end]
+    meta_version = info.get(b"meta version")
+    is_v2 = (
+        meta_version is not None
+        and torrent_file[meta_version[0] : meta_version[1]] == b"i2e"
+    )
+    # hybrid torrents carry the v1 piece table next to the v2 file tree
+    is_v1 = b"pieces" in info or not is_v2
+
+    return InfoHashes(
+        v1=hashlib.sha1(info_bytes).hexdigest() if is_v1 else None,
+        v2=hashlib.sha256(info_bytes).hexdigest() if is_v2 else None,
+    )
@@ -0,0 +1,135 @@
+# https://github.com/qbittorrent/qBittorrent/wiki/WebUI-API-(qBittorrent-4.1)
+
+import json
+import asyncio
+import aiohttp
+from typing import Any, Dict, List, Optional
+
+from .models import TorrentFile, TorrentInfo
+from .exceptions import QBittorrentAPIError
+
+
+class QBittorrentClient:
+    """Minimal asyncio client for the qBittorrent WebUI endpoints we use.
+
+    One keep-alive session holds the login cookie; a 403 means the cookie
+    expired or was never issued, so the client logs in again and retries once.
+    """
+
+    def __init__(self, host: str, username: str, password: str) -> None:
+        if "://" not in host:
+            host = f"http://{host}"
+        self.base_url = host.rstrip("/")
+        self.username = username
+        self.password = password
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._login_lock = asyncio.Lock()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                # qBittorrent is usually reached by IP, which the default jar refuses
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=60),
+                # the WebUI CSRF protection compares Referer with its own host
+                headers={"Referer": self.base_url},
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def login(self) -> None:
+        async with self._get_session().post(
+            f"{self.base_url}/api/v2/auth/login",
+            data={"username": self.username, "password": self.password},
+        ) as response:
+            text = await response.text()
+            if response.status != 200 or text != "Ok.":
+                raise QBittorrentAPIError(
+                    f"Failed to log in to qBittorrent WebUI: {response.status} {text}"
+                )
+
+    async def _request(
+        self,
+        method: str,
+        endpoint: str,
+        params: Optional[Dict[str, Any]] = None,
+        data: Optional[Dict[str, Any]] = None,
+        files: Optional[Dict[str, bytes]] = None,
+    ) -> str:
+        for retry in (True, False):
+            if files is not None:
+                # a FormData can only be sent once, so it is built per attempt
+                form = aiohttp.FormData(data or {})
+                for name, content in files.items():
+                    form.add_field(
+                        name,
+                        content,
+                        filename=f"{name}.torrent",
+                        content_type="application/x-bittorrent",
+                    )
+                body: Any = form
+            else:
+                body = data
+
+            async with self._get_session().request(
+                method, f"{self.base_url}/api/v2/{endpoint}", params=params, data=body
+            ) as response:
+                text = await response.text()
+                if response.status == 403 and retry:
+                    async with self._login_lock:
+                        await self.login()
+                    continue
+                if response.status != 200:
+                    raise QBittorrentAPIError(
+                        f"{method} {endpoint} returned {response.status}: {text}"
+                    )
+                return text
+
+        raise QBittorrentAPIError(f"{method} {endpoint} is still forbidden after login.")
+
+    async def torrents_info(self, hashes: Optional[List[str]] = None) -> List[TorrentInfo]:
+        params = {"hashes": "|".join(hashes)} if hashes is not None else None
+        return json.loads(await self._request("GET", "torrents/info", params=params))
+
+    async def torrents_add(
+        self, torrent_file: bytes, save_path: str, sequential: bool = False
+    ) -> str:
+        data = {"savepath": save_path}
+        if sequential:
+            data["sequentialDownload"] = "true"
+            data["firstLastPiecePrio"] = "true"
+        return await self._request(
+            "POST", "torrents/add", data=data, files={"torrents": torrent_file}
+        )
+
+    async def torrents_properties(self, hash_str: str) -> Dict[str, Any]:
+        return json.loads(
+            await self._request("GET", "torrents/properties", params={"hash": hash_str})
+        )
+
+    async def torrents_files(self, hash_str: str) -> List[TorrentFile]:
+        return json.loads(
+            await self._request("GET", "torrents/files", params={"hash": hash_str})
+        )
+
+    async def torrents_piece_states(self, hash_str: str) -> List[int]:
+        return json.loads(
+            await self._request("GET", "torrents/pieceStates", params={"hash": hash_str})
+        )
+
+    async def torrents_reannounce(self, hashes: List[str]) -> None:
+        await self._request("POST", "torrents/reannounce", data={"hashes": "|".join(hashes)})
+
+    async def torrents_delete(self, hashes: List[str], delete_files: bool = False) -> None:
+        await self._request(
+            "POST",
+            "torrents/delete",
+            data={"hashes": "|".join(hashes), "deleteFiles": str(delete_files).lower()},
+        )
+
+    async def sync_maindata(self, rid: int = 0) -> Dict[str, Any]:
+        return json.loads(await self._request("GET", "sync/maindata", params={"rid": rid}))
@@ -18,3 +18,25 @@ class TorrentUnexistsError(Exception):
 
     def __repr__(self):
         return f"TorrentUnexistsError: {self.message}"
+
+
+class QBittorrentAPIError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+
+    def __str__(self):
+        return f"QBittorrentAPIError: {self.message}"
+
+    def __repr__(self):
+        return f"QBittorrentAPIError: {self.message}"
+
+
+class InvalidTorrentError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+
+    def __str__(self):
+        return f"InvalidTorrentError: {self.message}"
+
+    def __repr__(self):
+        return f"InvalidTorrentError: {self.message}"
@@ -1,4 +1,4 @@
-from typing import TypedDict
+from typing import List, TypedDict
 
 
 class TorrentInfo(TypedDict):
@@ -54,3 +54,15 @@ class TorrentInfo(TypedDict):
     uploaded: int
     uploaded_session: int
     upspeed: int
+
+
+class TorrentFile(TypedDict):
+    # https://github.com/qbittorrent/qBittorrent/wiki/WebUI-API-(qBittorrent-4.1)#get-torrent-contents
+    index: int
+    name: str
+    size: int
+    progress: float
+    priority: int
+    is_seed: bool
+    piece_range: List[int]
+    availability: float
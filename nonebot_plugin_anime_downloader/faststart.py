@@ -0,0 +1,254 @@
+# https://developer.apple.com/documentation/quicktime-file-format
+
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Callable, List, NamedTuple
+
+
+MP4_SUFFIXES = (".mp4", ".m4v", ".mov")
+
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"  # Matroska / WebM
+
+# boxes on the way from moov to the chunk offset tables
+CONTAINER_BOXES = (b"moov", b"trak", b"mdia", b"minf", b"stbl")
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# bytes compared at the start of every chunk to verify a rewritten file
+VERIFY_SAMPLE_BYTES = 64
+
+
+class FaststartError(Exception):
+    pass
+
+
+class Box(NamedTuple):
+    type: bytes
+    offset: int
+    size: int
+
+
+def read_boxes(file: BinaryIO, file_size: int) -> List[Box]:
+    """Read the top-level boxes of an MP4 file.
+
+    Raises:
+        FaststartError: If the file is not a well-formed MP4 file.
+    """
+    boxes = []
+    offset = 0
+    while offset < file_size:
+        file.seek(offset)
+        header = file.read(8)
+        if len(header) < 8:
+            raise FaststartError(f"Truncated box header at {offset}.")
+
+        size, type_ = struct.unpack(">I4s", header)
+        if size == 1:
+            (size,) = struct.unpack(">Q", file.read(8))
+        elif size == 0:
+            size = file_size - offset
+
+        if size < 8 or offset + size > file_size:
+            raise FaststartError(f"Invalid size of box {type_!r} at {offset}.")
+
+        boxes.append(Box(type_, offset, size))
+        offset += size
+
+    return boxes
+
+
+def _box(type_: bytes, body: bytes) -> bytes:
+    return struct.pack(">I4s", len(body) + 8, type_) + body
+
+
+def _rewrite_offsets(data: bytes, shift: Callable[[int], int], use_co64: bool) -> bytes:
+    output = bytearray()
+    position = 0
+    while position < len(data):
+        size, type_ = struct.unpack_from(">I4s", data, position)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, position + 8)
+            header_size = 16
+        elif size == 0:
+            size = len(data) - position
+        if size < header_size or position + size > len(data):
+            raise FaststartError(f"Invalid size of box {type_!r} in moov.")
+
+        body = data[position + header_size : position + size]
+        if type_ in CONTAINER_BOXES:
+            body = _rewrite_offsets(body, shift, use_co64)
+        elif type_ in (b"stco", b"co64"):
+            version_flags, count = struct.unpack_from(">4sI", body)
+            entry_format = "I" if type_ == b"stco" else "Q"
+            offsets = [shift(offset) for offset in struct.unpack_from(f">{count}{entry_format}", body, 8)]
+            if use_co64 or type_ == b"co64":
+                type_, entry_format = b"co64", "Q"
+            elif offsets and max(offsets) > 0xFFFFFFFF:
+                raise OverflowError
+            body = version_flags + struct.pack(f">I{count}{entry_format}", count, *offsets)
+        elif type_ == b"cmov":
+            raise FaststartError("Compressed moov is not supported.")
+
+        output += _box(type_, body)
+        position += size
+
+    return bytes(output)
+
+
+def _make_shift(mdat_offset: int, moov: Box, new_moov_size: int) -> Callable[[int], int]:
+    def shift(offset: int) -> int:
+        if offset < mdat_offset:
+            return offset
+        # between the first mdat and the old moov, pushed back by the new moov
+        if offset < moov.offset:
+            return offset + new_moov_size
+        return offset + new_moov_size - moov.size
+
+    return shift
+
+
+def _chunk_offsets(data: bytes) -> List[int]:
+    offsets = []
+    position = 0
+    while position < len(data):
+        size, type_ = struct.unpack_from(">I4s", data, position)
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, position + 8)
+            header_size = 16
+        body = data[position + header_size : position + size]
+        if type_ in CONTAINER_BOXES:
+            offsets += _chunk_offsets(body)
+        elif type_ in (b"stco", b"co64"):
+            (count,) = struct.unpack_from(">I", body, 4)
+            entry_format = "I" if type_ == b"stco" else "Q"
+            offsets += struct.unpack_from(f">{count}{entry_format}", body, 8)
+        position += size
+    return offsets
+
+
+def needs_faststart(path: Path) -> bool:
+    """Check whether a video is an MP4 file with its moov box after the media data."""
+    if path.suffix.lower() not in MP4_SUFFIXES:
+        return False
+
+    with open(path, "rb") as file:
+        if file.read(4) == EBML_MAGIC:
+            # an MKV file with the wrong suffix, which has no moov to move
+            return False
+        try:
+            boxes = read_boxes(file, os.fstat(file.fileno()).st_size)
+        except FaststartError:
+            return False
+
+    types = [box.type for box in boxes]
+    if b"moov" not in types or b"mdat" not in types or b"moof" in types:
+        # fragmented MP4s keep their offsets relative to each fragment
+        return False
+    return types.index(b"moov") > types.index(b"mdat")
+
+
+def faststart(source: Path, target: Path) -> bool:
+    """Write a copy of an MP4 file with its moov box in front of the media data.
+
+    The copy is written next to `target` and only moved there once it is
+    verified, and the source is never modified.
+
+    Args:
+        source: The path of the MP4 file.
+        target: The path of the rewritten file.
+
+    Returns:
+        Whether the file was rewritten. MKV files, fragmented MP4 files and
+        MP4 files that already start with moov are left alone.
+
+    Raises:
+        FaststartError: If the file is malformed or the rewrite fails to verify.
+    """
+    if not needs_faststart(source):
+        return False
+
+    temp = target.with_name(f"{target.name}.part")
+    target.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(source, "rb") as src:
+        source_size = os.fstat(src.fileno()).st_size
+        boxes = read_boxes(src, source_size)
+        moov = next(box for box in boxes if box.type == b"moov")
+        first_mdat = next(box for box in boxes if box.type == b"mdat")
+        src.seek(moov.offset)
+        moov_data = src.read(moov.size)
+
+        new_moov = b""
+        use_co64 = False
+        new_size = moov.size
+        # offsets grow with the moov, which may turn stco into co64 and grow it again
+        for _ in range(4):
+            shift = _make_shift(first_mdat.offset, moov, new_size)
+            try:
+                new_moov = _rewrite_offsets(moov_data, shift, use_co64)
+            except OverflowError:
+                use_co64 = True
+                continue
+            if len(new_moov) == new_size:
+                break
+            new_size = len(new_moov)
+        else:
+            raise FaststartError("The size of the rewritten moov does not converge.")
+
+        try:
+            with open(temp, "wb") as dst:
+                for box in boxes:
+                    if box is first_mdat:
+                        dst.write(new_moov)
+                    if box is moov:
+                        continue
+                    src.seek(box.offset)
+                    _copy(src, dst, box.size)
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            _verify(source, temp, moov_data, new_moov, source_size - moov.size + new_size)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+
+    os.replace(temp, target)
+    return True
+
+
+def _copy(src: BinaryIO, dst: BinaryIO, size: int) -> None:
+    while size > 0:
+        data = src.read(min(size, COPY_CHUNK_SIZE))
+        if not data:
+            raise FaststartError("Unexpected end of file.")
+        dst.write(data)
+        size -= len(data)
+
+
+def _verify(
+    source: Path, rewritten: Path, old_moov: bytes, new_moov: bytes, expected_size: int
+) -> None:
+    if rewritten.stat().st_size != expected_size:
+        raise FaststartError("The rewritten file has an unexpected size.")
+
+    with open(rewritten, "rb") as file:
+        types = [box.type for box in read_boxes(file, expected_size)]
+    if types.index(b"moov") > types.index(b"mdat"):
+        raise FaststartError("The rewritten file still has moov after mdat.")
+
+    old_offsets = _chunk_offsets(old_moov)
+    new_offsets = _chunk_offsets(new_moov)
+    if len(old_offsets) != len(new_offsets):
+        raise FaststartError("The rewritten moov lost chunk offsets.")
+
+    # every chunk has to start with the same bytes as before
+    with open(source, "rb") as src, open(rewritten, "rb") as dst:
+        for old_offset, new_offset in zip(old_offsets, new_offsets):
+            src.seek(old_offset)
+            dst.seek(new_offset)
+            if src.read(VERIFY_SAMPLE_BYTES) != dst.read(VERIFY_SAMPLE_BYTES):
+                raise FaststartError("The rewritten chunk offsets are wrong.")
+
@@ -0,0 +1,139 @@
+from collections import deque
+from typing import Dict, List, Set, Tuple, Iterable, Optional
+
+from .utils import normalize_text
+from .metrics import MATCH_SECONDS, timed
+
+
+Subscription = Tuple[str, Tuple[str, ...]]  # (group/private_id, tags)
+
+
+class _Automaton:
+    """Aho-Corasick automaton over a fixed set of patterns."""
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[str]] = [[]]
+
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                state = next_state
+            self.output[state].append(pattern)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def search(self, text: str) -> Set[str]:
+        found: Set[str] = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.update(self.output[state])
+        return found
+
+
+class SubscriptionMatcher:
+    """In-memory index of every user's subscriptions.
+
+    A subscription matches a title when all of its tags are substrings of the
+    title, after both are normalized with `utils.normalize_text`. All distinct
+    tags are compiled into one Aho-Corasick automaton, so a title is normalized
+    and scanned once no matter how many subscriptions exist.
+    """
+
+    def __init__(self) -> None:
+        self._required: Dict[Subscription, Set[str]] = {}
+        # when each subscription was added, matches are returned in this order
+        self._order: Dict[Subscription, int] = {}
+        self._added = 0
+        self._by_tag: Dict[str, Set[Subscription]] = {}
+        self._match_all: Set[Subscription] = set()
+        self._automaton: Optional[_Automaton] = None
+
+    def __len__(self) -> int:
+        return len(self._required)
+
+    def add(self, user_id: str, tags: List[str]) -> None:
+        subscription = (user_id, tuple(tags))
+        if subscription in self._required:
+            return None
+
+        # empty tags are substrings of every title, so they never need scanning
+        required = {tag for tag in map(normalize_text, tags) if tag}
+        self._required[subscription] = required
+        self._order[subscription] = self._added
+        self._added += 1
+
+        if not required:
+            self._match_all.add(subscription)
+            return None
+
+        for tag in required:
+            if tag not in self._by_tag:
+                self._by_tag[tag] = set()
+                self._automaton = None
+            self._by_tag[tag].add(subscription)
+
+    def remove(self, user_id: str, tags: List[str]) -> None:
+        subscription = (user_id, tuple(tags))
+        required = self._required.pop(subscription, None)
+        if required is None:
+            return None
+
+        del self._order[subscription]
+        self._match_all.discard(subscription)
+        for tag in required:
+            subscriptions = self._by_tag[tag]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._by_tag[tag]
+                self._automaton = None
+
+    @timed(MATCH_SECONDS, function="SubscriptionMatcher.match")
+    def match(self, title: str) -> List[Subscription]:
+        """Find every subscription matching the title.
+
+        Args:
+            title: The title to check.
+
+        Returns:
+            A list of (user_id, tags) pairs whose tags all match the title,
+            in the order they were added.
+        """
+        matched = list(self._match_all)
+        if not self._by_tag:
+            return sorted(matched, key=self._order.__getitem__)
+
+        if self._automaton is None:
+            self._automaton = _Automaton(self._by_tag)
+
+        hits: Dict[Subscription, int] = {}
+        for tag in self._automaton.search(normalize_text(title)):
+            for subscription in self._by_tag[tag]:
+                hits[subscription] = hits.get(subscription, 0) + 1
+
+        matched += [
+            subscription
+            for subscription, count in hits.items()
+            if count == len(self._required[subscription])
+        ]
+        return sorted(matched, key=self._order.__getitem__)
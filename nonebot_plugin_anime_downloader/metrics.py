@@ -0,0 +1,290 @@
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+import time
+import asyncio
+import functools
+import threading
+from bisect import bisect_left
+from fastapi import FastAPI
+from starlette.responses import Response
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# parsing, matching and SQLite queries take micro- to milliseconds
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY: List["Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """A metric family, with one series per combination of label values.
+
+    Metrics may be updated from any thread, SQLite queries are timed on the
+    thread of aiosqlite.
+    """
+
+    type_ = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: LabelValues = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_}",
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type_ = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: LabelValues = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    type_ = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: LabelValues = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function: Optional[Callable[[], Dict[LabelValues, float]]] = None
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def set_function(self, function: Callable[[], Dict[LabelValues, float]]) -> None:
+        """Compute the values when scraped, instead of keeping them up to date.
+
+        Args:
+            function: Returns a dict mapping label values to values.
+        """
+        self._function = function
+
+    def samples(self) -> Iterator[str]:
+        if self._function is not None:
+            values = list(self._function().items())
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type_ = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: LabelValues = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # per series: the count of each bucket (not cumulative), sum and count
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * len(self.buckets), [0.0, 0])
+            series[0][index] += 1
+            series[1][0] += value
+            series[1][1] += 1
+
+    def count(self, **labels: Any) -> int:
+        series = self._series.get(self._key(labels))
+        return 0 if series is None else int(series[1][1])
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            series = [(key, list(counts), list(totals)) for key, (counts, totals) in self._series.items()]
+        for key, counts, (total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = self._format_labels(key, (("le", _format_value(bound)),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {_format_value(total)}"
+            yield f"{self.name}_count{self._format_labels(key)} {int(count)}"
+
+
+def timed(histogram: Histogram, **labels: Any) -> Callable[[F], F]:
+    """Observe how long each call of a function or coroutine function takes.
+
+    Failed calls are observed as well, a timeout is as slow as it gets.
+    """
+
+    def decorator(function: F) -> F:
+        if asyncio.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+
+            return async_wrapper  # type: ignore
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def render() -> str:
+    return "".join(metric.render() for metric in REGISTRY)
+
+
+def register_metrics(app: FastAPI) -> None:
+    """Serve every metric in the Prometheus text format at `/anime_downloader/metrics`.
+
+    Args:
+        app: The FastAPI app of the driver.
+    """
+    if not isinstance(app, FastAPI):
+        raise TypeError("app must be an instance of FastAPI.")
+
+    @app.get("/anime_downloader/metrics")
+    async def metrics():
+        return Response(render(), media_type=CONTENT_TYPE)
+
+
+# the poller and searches go through fetch_data and fetch_torrent_data
+ACGRIP_REQUEST_SECONDS = Histogram(
+    "anime_acgrip_request_seconds",
+    "Time spent requesting ACG.RIP, by function.",
+    ("function",),
+)
+ACGRIP_PARSE_SECONDS = Histogram(
+    "anime_acgrip_parse_seconds",
+    "Time spent extracting entries from ACG.RIP pages, by function.",
+    ("function",),
+    FAST_BUCKETS,
+)
+# new entries are matched by SubscriptionMatcher.match
+MATCH_SECONDS = Histogram(
+    "anime_match_seconds",
+    "Time spent matching titles against tags, by function.",
+    ("function",),
+    FAST_BUCKETS,
+)
+QBITTORRENT_CALL_SECONDS = Histogram(
+    "anime_qbittorrent_call_seconds",
+    "Time spent in TorrentDownloader calls to qBittorrent, by method.",
+    ("method",),
+)
+SQLITE_QUERY_SECONDS = Histogram(
+    "anime_sqlite_query_seconds",
+    "Time spent executing SQLite statements.",
+    buckets=FAST_BUCKETS,
+)
+JOB_SECONDS = Histogram(
+    "anime_job_seconds",
+    "Time spent in each run of a scheduled job, by job.",
+    ("job",),
+)
+SEARCH_CACHE_LOOKUPS = Counter(
+    "anime_search_cache_lookups_total",
+    "ACG.RIP searches of /anmsc, by whether the cache answered them fresh, stale or not at all.",
+    ("result",),
+)
+ENTRIES_INGESTED = Counter(
+    "anime_acgrip_entries_ingested_total",
+    "New ACG.RIP entries stored by the poller.",
+)
+TASKS = Gauge(
+    "anime_tasks",
+    "Download tasks, by status.",
+    ("status",),
+)
+STORAGE_USAGE_BYTES = Gauge(
+    "anime_storage_usage_bytes",
+    "Disk usage of the download folder, as of the last storage pass.",
+)
+STORAGE_EVICTED_BYTES = Counter(
+    "anime_storage_evicted_bytes_total",
+    "Bytes freed by evicting the least recently watched torrents.",
+)
+VIDEO_BYTES_SENT = Counter(
+    "anime_video_bytes_sent_total",
+    "Bytes of video bodies sent by /res/{video_id}.",
+)
+VIDEO_ACTIVE_STREAMS = Gauge(
+    "anime_video_active_streams",
+    "Video bodies being sent by /res/{video_id}.",
+)
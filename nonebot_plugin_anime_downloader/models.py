@@ -1,10 +1,35 @@
-from typing import TypedDict
+import asyncio
+from typing import Dict, List, Optional, TypedDict
 
+from .tracing import Trace
 from .downloader.models import TorrentInfo
 
 
+class TaskContent(TypedDict):
+    # the fields of TorrentInfo the plugin reads
+    hash: str
+    name: str
+    save_path: str
+    content_path: str
+
+
 class Task(TypedDict):
-    id: str  # group/private_id
-    content: TorrentInfo
+    ids: List[str]  # group/private_ids of everyone to notify
+    content: TaskContent
     torrent_id: int
     status: str
+
+
+class DownloadJob(TypedDict, total=False):
+    # filled in stage by stage while the job moves through the pipeline
+    title: str
+    entry: Dict[str, str]  # the ACG.RIP entry of a scheduled job
+    torrent_id: int
+    url: str
+    folder_name: str
+    user_ids: List[str]
+    torrent_data: bytes
+    torrent_info: TorrentInfo
+    add_attempted: bool
+    future: "asyncio.Future[Task]"  # resolved once the task is recorded
+    trace: Optional[Trace]  # of the poll that queued the job, if it was traced
@@ -0,0 +1,118 @@
+import random
+import asyncio
+from nonebot.log import logger
+from typing import Awaitable, Callable, Dict, Generic, List, Optional, Tuple, Type, TypeVar
+
+
+T = TypeVar("T")
+
+# the first retry waits up to this long, each further one up to twice as long
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 300.0
+
+
+class Stage(Generic[T]):
+    """A pool of workers handling the items of one queue.
+
+    Each item gets `timeout` seconds per attempt. A failed attempt is retried
+    up to `retries` times after a jittered exponential delay, during which the
+    worker moves on to other items. Items the handler passes on go to the
+    next stage, and items that fail for good go to `on_error`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[T], Awaitable[bool]],
+        workers: int,
+        timeout: float,
+        retries: int,
+        on_error: Callable[[T, Exception], None],
+        no_retry: Tuple[Type[Exception], ...] = (),
+    ) -> None:
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.on_error = on_error
+        self.no_retry = no_retry
+        self.next: Optional["Stage[T]"] = None
+        # created in the running loop, queues of Python < 3.10 bind to a loop
+        self._queue: Optional["asyncio.Queue[Tuple[T, int]]"] = None
+        self._tasks: List["asyncio.Task[None]"] = []
+
+    @property
+    def queue(self) -> "asyncio.Queue[Tuple[T, int]]":
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    def put(self, item: T, attempt: int = 0) -> None:
+        self.queue.put_nowait((item, attempt))
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(max(self.workers, 1))
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self) -> None:
+        while True:
+            item, attempt = await self.queue.get()
+            try:
+                await self._handle(item, attempt)
+            except Exception as e:
+                logger.opt(exception=e).error(f"Pipeline stage {self.name} crashed.")
+            finally:
+                self.queue.task_done()
+
+    async def _handle(self, item: T, attempt: int) -> None:
+        try:
+            passed = await asyncio.wait_for(self.handler(item), self.timeout)
+        except self.no_retry as e:
+            self.on_error(item, e)
+            return None
+        except Exception as e:
+            if attempt >= self.retries:
+                self.on_error(item, e)
+                return None
+            # full jitter, so items that failed together don't retry together
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+            logger.debug(
+                f"Pipeline stage {self.name} failed with {type(e).__name__}: {e}, "
+                f"retrying in {delay:.1f}s."
+            )
+            asyncio.get_running_loop().call_later(delay, self.put, item, attempt + 1)
+            return None
+
+        if passed and self.next is not None:
+            self.next.put(item)
+
+
+class Pipeline(Generic[T]):
+    """Stages chained by queues, so every stage works at its own pace."""
+
+    def __init__(self, stages: List[Stage[T]]) -> None:
+        self.stages: Dict[str, Stage[T]] = {stage.name: stage for stage in stages}
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+        self._first = stages[0]
+
+    def __getitem__(self, name: str) -> Stage[T]:
+        return self.stages[name]
+
+    def put(self, item: T) -> None:
+        self._first.put(item)
+
+    def start(self) -> None:
+        for stage in self.stages.values():
+            stage.start()
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(stage.stop() for stage in self.stages.values()))
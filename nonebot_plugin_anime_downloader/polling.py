@@ -0,0 +1,105 @@
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from apscheduler.triggers.base import BaseTrigger
+
+
+SLOT_SECONDS = 15 * 60
+SLOTS_PER_WEEK = 7 * 24 * 3600 // SLOT_SECONDS
+
+# fansubs release on a weekly schedule, a few weeks show it reliably
+HISTORY_DAYS = 28
+
+# a release somebody subscribed to counts as much as this many others
+SUBSCRIBED_WEIGHT = 10.0
+
+
+class ReleaseProfile:
+    """How busy each quarter hour of the week is, learned from past releases.
+
+    Releases are counted in the slot of the week they arrived in, so a show
+    airing every Sunday evening makes Sunday evenings busy. Releases that
+    match a subscription weigh more, since those are the ones to be quick on.
+    """
+
+    def __init__(self) -> None:
+        self.weights: List[float] = [0.0] * SLOTS_PER_WEEK
+        self.peak = 0.0
+        self.built_at = 0.0
+
+    @staticmethod
+    def slot(timestamp: float) -> int:
+        return int(timestamp // SLOT_SECONDS) % SLOTS_PER_WEEK
+
+    def rebuild(self, releases: Iterable[Tuple[int, float]]) -> None:
+        """Replace the profile.
+
+        Args:
+            releases: Pairs of release times and their weights.
+        """
+        self.weights = [0.0] * SLOTS_PER_WEEK
+        self.peak = 0.0
+        for timestamp, weight in releases:
+            self.add(timestamp, weight)
+        self.built_at = time.time()
+
+    def add(self, timestamp: int, weight: float = 1.0) -> None:
+        slot = self.slot(timestamp)
+        self.weights[slot] += weight
+        self.peak = max(self.peak, self.weights[slot])
+
+    def activity(self, timestamp: float) -> Optional[float]:
+        """Get how busy the time is, from 0 for quiet to 1 for the busiest slot.
+
+        Releases are often a little early or late, so neighbouring slots
+        count as well. Returns None while nothing has been learned.
+        """
+        if self.peak == 0:
+            return None
+        slot = self.slot(timestamp)
+        weight = max(
+            self.weights[(slot + offset) % SLOTS_PER_WEEK] for offset in (-1, 0, 1)
+        )
+        return weight / self.peak
+
+    def interval(
+        self, timestamp: float, min_interval: float, max_interval: float
+    ) -> Optional[float]:
+        """Get how long to wait before the next poll.
+
+        Busy times are polled every `min_interval` and quiet ones every
+        `max_interval`, with geometric steps in between. A poll is never
+        scheduled past the start of a busier window.
+
+        Returns:
+            The interval in seconds, or None while nothing has been learned.
+        """
+        if self.peak == 0:
+            return None
+
+        def interval_at(timestamp: float) -> float:
+            activity = self.activity(timestamp) or 0.0
+            return max_interval * (min_interval / max_interval) ** activity
+
+        interval = interval_at(timestamp)
+        slot_start = (timestamp // SLOT_SECONDS + 1) * SLOT_SECONDS
+        while slot_start < timestamp + interval:
+            interval = min(interval, slot_start - timestamp + interval_at(slot_start))
+            slot_start += SLOT_SECONDS
+        return max(interval, min_interval)
+
+
+class AdaptiveIntervalTrigger(BaseTrigger):
+    """An APScheduler trigger that asks for the next interval after every run."""
+
+    def __init__(self, get_interval: Callable[[datetime], float]) -> None:
+        self.get_interval = get_interval
+
+    def get_next_fire_time(
+        self, previous_fire_time: Optional[datetime], now: datetime
+    ) -> datetime:
+        return now + timedelta(seconds=self.get_interval(now))
+
+    def __str__(self) -> str:
+        return "adaptive interval"
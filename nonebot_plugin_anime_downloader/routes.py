@@ -1,82 +1,542 @@
-from typing import List
+import os
+import time
+import anyio
+import asyncio
+import secrets
+from stat import S_ISREG
 from pathlib import Path
 from nonebot.log import logger
-from fastapi import FastAPI, Request
-from fastapi.templating import Jinja2Templates
-from fastapi.responses import StreamingResponse
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import FastAPI, HTTPException, Request
+from starlette.responses import Response
+from anyio.abc import TaskGroup
+from starlette.types import Message, Receive, Scope, Send
+
+from .streaming import StreamingVideo
+from .metrics import VIDEO_ACTIVE_STREAMS, VIDEO_BYTES_SENT
+
+if TYPE_CHECKING:
+    from fastapi.templating import Jinja2Templates
+
+
+CHUNK_SIZE = 1024 * 1024
+
+# requests with more ranges than this are answered with the whole file
+MAX_RANGES = 16
+
+# chunks read ahead of each stream, so the next one is usually already cached
+READ_AHEAD_CHUNKS = 2
+
+ChunkKey = Tuple[str, int, int, int]  # path, mtime_ns, size, chunk index
+
+
+def parse_range(range_header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """Parse a Range header into sorted, merged, inclusive byte ranges.
+
+    Example:
+        parse_range("bytes=0-99", 1000) -> [(0, 99)]
+        parse_range("bytes=-100", 1000) -> [(900, 999)]
+        parse_range("bytes=500-,0-9", 1000) -> [(0, 9), (500, 999)]
+        parse_range("bytes=2000-", 1000) -> []
+
+    Args:
+        range_header: The value of the Range header.
+        file_size: The size of the file in bytes.
+
+    Returns:
+        The satisfiable ranges, an empty list if none is satisfiable, or None
+        if the header is malformed and has to be ignored.
+    """
+    unit, _, ranges_spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+
+    specs = [spec.strip() for spec in ranges_spec.split(",") if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+
+    ranges: List[Tuple[int, int]] = []
+    for spec in specs:
+        first, dash, last = (part.strip() for part in spec.partition("-"))
+        if not dash or not (first.isdigit() or first == ""):
+            return None
+        if not (last.isdigit() or last == "") or first == last == "":
+            return None
+
+        if first == "":
+            # suffix range: the last N bytes
+            length = int(last)
+            if length > 0 and file_size > 0:
+                ranges.append((max(file_size - length, 0), file_size - 1))
+            continue
+
+        start = int(first)
+        end = int(last) if last else file_size - 1
+        if last and end < start:
+            return None
+        if start < file_size:
+            ranges.append((start, min(end, file_size - 1)))
+
+    ranges.sort()
+    merged: List[Tuple[int, int]] = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _read_chunk(path: Path, index: int) -> bytes:
+    with open(path, "rb") as file:
+        file.seek(index * CHUNK_SIZE)
+        return file.read(CHUNK_SIZE)
+
+
+class ChunkCache:
+    """A bounded LRU cache of aligned file chunks shared by all video requests.
+
+    When a new episode lands, everyone watching it reads the same bytes at
+    about the same time. Concurrent reads of a chunk are coalesced into one
+    disk read, and the chunk stays in memory for the viewers behind.
+
+    Chunks are keyed by path, mtime and size, so a file that changes on disk
+    is never served from stale chunks.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks: "OrderedDict[ChunkKey, bytes]" = OrderedDict()
+        self._pending: Dict[ChunkKey, "asyncio.Task[bytes]"] = {}
+
+    def __contains__(self, key: ChunkKey) -> bool:
+        return key in self._chunks or key in self._pending
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "chunks": len(self._chunks),
+            "size": self.size,
+        }
+
+    async def get(self, path: Path, key: ChunkKey) -> bytes:
+        """Get a chunk, reading it from disk at most once.
+
+        Args:
+            path: The path of the file.
+            key: The key of the chunk.
+
+        Returns:
+            The bytes of the chunk, which are shorter than `CHUNK_SIZE` for
+            the last chunk of the file.
+        """
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            # the read is not tied to this request, cancelling it must not
+            # fail the other requests waiting for the same chunk
+            task = asyncio.ensure_future(self._load(path, key))
+            self._pending[key] = task
+        else:
+            self.hits += 1
+        return await asyncio.shield(task)
+
+    async def _load(self, path: Path, key: ChunkKey) -> bytes:
+        try:
+            chunk = await anyio.to_thread.run_sync(_read_chunk, path, key[3])
+        finally:
+            del self._pending[key]
+
+        self._put(key, chunk)
+        return chunk
+
+    async def prefetch(self, path: Path, key: ChunkKey) -> None:
+        if key in self:
+            return None
+        try:
+            await self.get(path, key)
+        except OSError as e:
+            logger.debug(f"Failed to read ahead {path}: {e}")
+
+    def _put(self, key: ChunkKey, chunk: bytes) -> None:
+        if len(chunk) > self.max_size:
+            return None
+
+        self._chunks[key] = chunk
+        self.size += len(chunk)
+        while self.size > self.max_size:
+            _, evicted = self._chunks.popitem(last=False)
+            self.size -= len(evicted)
+
+
+class VideoFileResponse(Response):
+    """A file response implementing conditional and byte range requests.
+
+    Handles single, multiple and suffix ranges, 416 for unsatisfiable ranges,
+    If-Range, ETag / Last-Modified revalidation and HEAD. The body goes out
+    through the server's zero-copy extension when it offers one, and is read
+    in a worker thread otherwise, through `cache` if one is given, so the
+    event loop never blocks on disk.
+
+    If `stream` is given, the file is still downloading: its size is taken
+    from the torrent, and every chunk waits for its pieces before it is sent.
+
+    `stat` is the result of `os.stat` of the file, which the caller takes
+    off the event loop.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        stat: os.stat_result,
+        request: Request,
+        media_type: str,
+        cache: Optional[ChunkCache] = None,
+        stream: Optional[StreamingVideo] = None,
+    ) -> None:
+        super().__init__(status_code=200, media_type=media_type)
+        self.path = path
+        self.cache = cache
+        self.stream = stream
+        self.method = request.method
+        self.ranges: List[Tuple[int, int]] = []
+        self.boundary = ""
+
+        # a downloading file may be shorter than the file it will become
+        self.file_size = stat.st_size if stream is None else stream.size
+        self.mtime_ns = stat.st_mtime_ns
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+        self.headers["Accept-Ranges"] = "bytes"
+        self.headers["ETag"] = etag
+        self.headers["Last-Modified"] = last_modified
+
+        if self._is_not_modified(request, etag, stat.st_mtime):
+            self.status_code = 304
+            del self.headers["Content-Length"]
+            del self.headers["Content-Type"]
+            return None
+
+        range_header = request.headers.get("Range")
+        if range_header and self._is_if_range_fresh(request, etag, last_modified):
+            ranges = parse_range(range_header, self.file_size)
+            if ranges == []:
+                self.status_code = 416
+                self.headers["Content-Range"] = f"bytes */{self.file_size}"
+                self.headers["Content-Length"] = "0"
+                return None
+            if ranges:
+                self.status_code = 206
+                self.ranges = ranges
+
+        if len(self.ranges) == 1:
+            start, end = self.ranges[0]
+            self.headers["Content-Range"] = f"bytes {start}-{end}/{self.file_size}"
+            self.headers["Content-Length"] = str(end - start + 1)
+        elif self.ranges:
+            self.boundary = secrets.token_hex(16)
+            self.headers["Content-Type"] = f"multipart/byteranges; boundary={self.boundary}"
+            self.headers["Content-Length"] = str(
+                sum(len(head) + end - start + 1 for head, start, end in self._segments())
+                + len(self._closing())
+            )
+        else:
+            self.headers["Content-Length"] = str(self.file_size)
+
+    @staticmethod
+    def _is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            # If-None-Match uses the weak comparison
+            return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+        if_modified_since = request.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+
+        return False
+
+    @staticmethod
+    def _is_if_range_fresh(request: Request, etag: str, last_modified: str) -> bool:
+        if_range = request.headers.get("If-Range")
+        if if_range is None:
+            return True
+        # If-Range uses the strong comparison, so weak tags never match
+        return if_range.strip() in (etag, last_modified)
+
+    def _segments(self) -> List[Tuple[bytes, int, int]]:
+        if not self.boundary:
+            start, end = self.ranges[0] if self.ranges else (0, self.file_size - 1)
+            return [(b"", start, end)]
+
+        return [
+            (
+                (
+                    f"\r\n--{self.boundary}\r\n"
+                    f"Content-Type: {self.media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{self.file_size}\r\n\r\n"
+                ).encode(),
+                start,
+                end,
+            )
+            for start, end in self.ranges
+        ]
+
+    def _closing(self) -> bytes:
+        return f"\r\n--{self.boundary}--\r\n".encode() if self.boundary else b""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+
+        if self.method == "HEAD" or self.status_code in (304, 416) or not self.file_size:
+            await send({"type": "http.response.body", "body": b""})
+            return None
+
+        async def counting_send(message: Message) -> None:
+            await send(message)
+            VIDEO_BYTES_SENT.inc(
+                message["count"]
+                if message["type"] == "http.response.zerocopysend"
+                else len(message.get("body", b""))
+            )
+
+        VIDEO_ACTIVE_STREAMS.inc()
+        try:
+            async with anyio.create_task_group() as task_group:
+
+                async def wait_for_disconnect() -> None:
+                    while (await receive())["type"] != "http.disconnect":
+                        pass
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(wait_for_disconnect)
+                await self._send_body(scope, counting_send, task_group)
+                task_group.cancel_scope.cancel()
+        finally:
+            VIDEO_ACTIVE_STREAMS.dec()
+
+    async def _send_body(self, scope: Scope, send: Send, task_group: TaskGroup) -> None:
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        if self.cache is not None and self.stream is None and not zerocopy:
+            # sendfile already shares the page cache, chunks only help reads
+            return await self._send_cached_body(send, task_group)
+
+        file = await anyio.to_thread.run_sync(open, self.path, "rb")
+        with file:
+            for head, start, end in self._segments():
+                if head:
+                    await send({"type": "http.response.body", "body": head, "more_body": True})
+
+                if zerocopy and self.stream is None:
+                    await send(
+                        {
+                            "type": "http.response.zerocopysend",
+                            "file": file.fileno(),
+                            "offset": start,
+                            "count": end - start + 1,
+                            "more_body": True,
+                        }
+                    )
+                    continue
+
+                await anyio.to_thread.run_sync(file.seek, start)
+                position = start
+                while position <= end:
+                    count = min(end - position + 1, CHUNK_SIZE)
+                    if self.stream is not None and not await self.stream.wait(
+                        position, position + count - 1
+                    ):
+                        # the body can't be completed, let the server drop the connection
+                        logger.warning(f"Pieces of {self.path.name} did not arrive in time.")
+                        return None
+
+                    if zerocopy:
+                        await send(
+                            {
+                                "type": "http.response.zerocopysend",
+                                "file": file.fileno(),
+                                "offset": position,
+                                "count": count,
+                                "more_body": True,
+                            }
+                        )
+                        position += count
+                        continue
+
+                    data = await anyio.to_thread.run_sync(file.read, count)
+                    if not data:
+                        break
+                    position += len(data)
+                    await send({"type": "http.response.body", "body": data, "more_body": True})
+
+        await send({"type": "http.response.body", "body": self._closing()})
+
+    async def _send_cached_body(self, send: Send, task_group: TaskGroup) -> None:
+        assert self.cache is not None
+
+        for head, start, end in self._segments():
+            if head:
+                await send({"type": "http.response.body", "body": head, "more_body": True})
+
+            last_index = end // CHUNK_SIZE
+            for index in range(start // CHUNK_SIZE, last_index + 1):
+                for ahead in range(index + 1, min(index + READ_AHEAD_CHUNKS, last_index) + 1):
+                    task_group.start_soon(self.cache.prefetch, self.path, self._key(ahead))
+
+                chunk = await self.cache.get(self.path, self._key(index))
+                offset = index * CHUNK_SIZE
+                data = chunk[max(start - offset, 0) : end - offset + 1]
+                await send({"type": "http.response.body", "body": data, "more_body": True})
+
+        await send({"type": "http.response.body", "body": self._closing()})
+
+    def _key(self, index: int) -> ChunkKey:
+        return (str(self.path), self.mtime_ns, self.file_size, index)
 
 
 class VideoManager:
-    def __init__(self, app: FastAPI, download_path: Path):
+    """Serves every video through two parameterized routes.
+
+    Videos live in a dict keyed by video id, so adding or removing one never
+    touches the router, and each request costs one dict lookup. File chunks
+    are shared by all requests through a cache of `cache_size` bytes, which
+    is disabled if `cache_size` is 0.
+
+    Videos that are still downloading are added with `add_stream`, and are
+    replaced by `add_video` once the download finishes.
+
+    The time each video was last requested is kept in `last_access`, until
+    it is taken out and stored with the catalog.
+    """
+
+    def __init__(self, app: FastAPI, download_path: Path, cache_size: int = 0):
         if not isinstance(app, FastAPI):
             raise TypeError("app must be an instance of FastAPI.")
 
-        self.ids: List[int] = []
+        self.videos: Dict[int, Path] = {}
+        self.streams: Dict[int, StreamingVideo] = {}
+        self.last_access: Dict[int, float] = {}
+        self.cache = ChunkCache(cache_size) if cache_size > 0 else None
         self.app = app
         self.download_path = download_path
-        self.templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
+        self._templates: Optional["Jinja2Templates"] = None
 
-    def add_route(self, video_path: Path, torrent_id: int) -> None:
-        if torrent_id in self.ids:
-            return None
+        self.app.get("/anime/{video_id}")(self.anime_page)
+        self.app.api_route("/res/{video_id}", methods=["GET", "HEAD"])(self.anime_res)
 
-        self.ids.append(torrent_id)
-
-        @self.app.get(f"/anime/{torrent_id}")
-        async def anime_page(request: Request):
-            return self.templates.TemplateResponse(
-                "index.html",
-                {
-                    "request": request,
-                    "title": video_path.name,
-                    "video_url": f"/res/{torrent_id}",
-                    "mime_type": f"video/{video_path.suffix[1:]}",
-                },
-            )
+    def __contains__(self, video_id: int) -> bool:
+        return video_id in self.videos
 
-        @self.app.get(f"/res/{torrent_id}")
-        async def anime_res(request: Request):
-            file_size = video_path.stat().st_size
-            start, end = 0, file_size - 1
-            range_header = request.headers.get("Range")
-            if range_header:
-                start, end = range_header.replace("bytes=", "").split("-")
-                start = int(start)
-                end = int(end) if end else file_size - 1
-                status_code = 206
-            else:
-                status_code = 200
-
-            def iterfile():
-                with open(video_path, mode="rb") as file_like:
-                    file_like.seek(start)
-                    bytes_to_send = end - start + 1
-                    while bytes_to_send > 0:
-                        chunk_size = min(
-                            bytes_to_send, 1024 * 1024
-                        )  # 1MB chunks or less
-                        data = file_like.read(chunk_size)
-                        if not data:
-                            break
-                        yield data
-                        bytes_to_send -= len(data)
-
-            headers = {
-                "Content-Range": f"bytes {start}-{end}/{file_size}",
-                "Accept-Ranges": "bytes",
-                "Content-Length": str(end - start + 1),
-                "Content-Type": f"video/{video_path.suffix[1:]}",
-            }
+    @property
+    def templates(self) -> "Jinja2Templates":
+        # Jinja2 is only imported once the first page is requested
+        if self._templates is None:
+            from fastapi.templating import Jinja2Templates
+
+            self._templates = Jinja2Templates(directory=Path(__file__).parent / "templates")
+        return self._templates
+
+    def _get_video_path(self, video_id: int) -> Path:
+        video_path = self.videos.get(video_id)
+        if video_path is None:
+            raise HTTPException(status_code=404, detail="Video not found.")
+        return video_path
+
+    async def anime_page(self, request: Request, video_id: int):
+        video_path = self._get_video_path(video_id)
+        return self.templates.TemplateResponse(
+            request,
+            "index.html",
+            {
+                "title": video_path.name,
+                "video_url": f"/res/{video_id}",
+                "mime_type": f"video/{video_path.suffix[1:]}",
+            },
+        )
 
-            return StreamingResponse(
-                iterfile(),
-                status_code=status_code,
-                headers=headers,
+    async def anime_res(self, request: Request, video_id: int):
+        video_path = self._get_video_path(video_id)
+        self.last_access[video_id] = time.time()
+        stream = self.streams.get(video_id)
+        # an unfinished file may be kept elsewhere until it is finished
+        file_path = video_path if stream is None else stream.path
+        # stat calls on a network share are slow, so they don't run on the event loop
+        try:
+            video_stat = await anyio.to_thread.run_sync(os.stat, file_path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Video file not found.")
+        if not S_ISREG(video_stat.st_mode):
+            raise HTTPException(status_code=404, detail="Video file not found.")
+
+        if stream is None:
+            return VideoFileResponse(
+                video_path,
+                video_stat,
+                request,
                 media_type=f"video/{video_path.suffix[1:]}",
+                cache=self.cache,
+            )
+
+        # wait for the first requested bytes, so players are not sent a
+        # response that stalls right away
+        ranges = parse_range(request.headers.get("Range", ""), stream.size)
+        start = ranges[0][0] if ranges else 0
+        if start < stream.size and not await stream.wait(
+            start, min(start + CHUNK_SIZE, stream.size) - 1
+        ):
+            raise HTTPException(
+                status_code=503,
+                detail="This part of the video is not downloaded yet.",
+                headers={"Retry-After": "10"},
             )
+        # a downloading file changes all the time, caching its chunks is useless
+        return VideoFileResponse(
+            file_path,
+            video_stat,
+            request,
+            media_type=f"video/{video_path.suffix[1:]}",
+            stream=stream,
+        )
+
+    def add_video(self, video_path: Path, video_id: int) -> None:
+        self.videos[video_id] = video_path
+        self.streams.pop(video_id, None)
+
+    def add_stream(self, stream: StreamingVideo, video_id: int) -> None:
+        self.videos[video_id] = stream.final_path
+        self.streams[video_id] = stream
+
+    def add_videos(self, video_paths: List[Path], video_ids: List[int]) -> None:
+        for video_path, video_id in zip(video_paths, video_ids):
+            self.add_video(video_path, video_id)
 
-    def add_routes(self, video_paths: List[Path], torrent_ids: List[int]) -> None:
-        for video_path, torrent_id in zip(video_paths, torrent_ids):
-            self.add_route(video_path, torrent_id)
+        logger.success(f"Added {len(video_paths)} videos.")
 
-        logger.success(f"Added routes for {len(video_paths)} videos.")
+    def remove_video(self, video_id: int) -> None:
+        self.videos.pop(video_id, None)
+        self.streams.pop(video_id, None)
+        self.last_access.pop(video_id, None)
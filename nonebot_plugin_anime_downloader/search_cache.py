@@ -0,0 +1,100 @@
+import time
+import asyncio
+from collections import OrderedDict
+from nonebot.log import logger
+from typing import Awaitable, Callable, Dict, Generic, List, Optional, Tuple, TypeVar
+
+from .utils import normalize_text
+from .metrics import SEARCH_CACHE_LOOKUPS
+
+
+T = TypeVar("T")
+
+Key = Tuple[str, ...]
+
+
+class SearchCache(Generic[T]):
+    """LRU cache of search results, with stale-while-revalidate.
+
+    Results younger than `ttl` seconds are answered from the cache. Results
+    up to `stale` seconds older than that are answered from the cache as
+    well, while one background search refreshes them. Concurrent searches
+    for the same tags share one in-flight request, whether the cache held
+    them or not. Failed searches are not cached.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[List[str]], Awaitable[T]],
+        size: int,
+        ttl: float,
+        stale: float = 0,
+    ) -> None:
+        self.fetch = fetch
+        self.size = size
+        self.ttl = ttl
+        self.stale = stale
+        self._entries: "OrderedDict[Key, Tuple[float, T]]" = OrderedDict()
+        self._inflight: Dict[Key, "asyncio.Task[T]"] = {}
+
+    @staticmethod
+    def key(tags: List[str]) -> Key:
+        """Searches differing only in case, script or blank tags share a key."""
+        return tuple(normalize_text(tag.strip()) for tag in tags if tag.strip())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, tags: List[str]) -> T:
+        key = self.key(tags)
+        entry = self._lookup(key)
+        if entry is None:
+            SEARCH_CACHE_LOOKUPS.inc(result="miss")
+            # a cancelled caller must not cancel the search others wait on
+            return await asyncio.shield(self._refresh(key, tags))
+
+        stored_at, value = entry
+        if time.monotonic() - stored_at < self.ttl:
+            SEARCH_CACHE_LOOKUPS.inc(result="hit")
+        else:
+            SEARCH_CACHE_LOOKUPS.inc(result="stale")
+            if key not in self._inflight:
+                self._refresh(key, tags).add_done_callback(self._log_refresh_error)
+        return value
+
+    def _lookup(self, key: Key) -> Optional[Tuple[float, T]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.ttl + self.stale:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _refresh(self, key: Key, tags: List[str]) -> "asyncio.Task[T]":
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.create_task(self._load(key, tags))
+        return task
+
+    async def _load(self, key: Key, tags: List[str]) -> T:
+        try:
+            value = await self.fetch(tags)
+        finally:
+            del self._inflight[key]
+
+        if self.ttl > 0 and self.size > 0:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return value
+
+    @staticmethod
+    def _log_refresh_error(task: "asyncio.Task[T]") -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                f"Failed to refresh a cached search, serving the stale results. "
+                f"{type(task.exception()).__name__}: {task.exception()}"
+            )
@@ -0,0 +1,236 @@
+import os
+import asyncio
+from pathlib import Path
+from nonebot.log import logger
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .data_source import Video
+from .routes import VideoManager
+from .database import VideoRepository
+from .downloader import TorrentDownloader
+from .downloader.models import TorrentInfo
+from .metrics import STORAGE_EVICTED_BYTES
+
+
+def get_disk_usage(path: Path) -> int:
+    """Get the bytes the files under a folder take up on disk.
+
+    Blocks are counted where the platform reports them, so preallocated and
+    sparse files of unfinished downloads count as much as they really take.
+    """
+    usage = 0
+    folders = [path]
+    while folders:
+        try:
+            entries = list(os.scandir(folders.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(Path(entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    blocks = getattr(stat, "st_blocks", None)
+                    usage += stat.st_size if blocks is None else blocks * 512
+            except OSError:
+                continue
+    return usage
+
+
+def remove_file(path: Optional[str]) -> int:
+    """Delete a file if it exists.
+
+    Returns:
+        The bytes freed.
+    """
+    if path is None:
+        return 0
+    try:
+        size = os.stat(path).st_size
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logger.warning(f"Failed to delete {path}: {e}")
+        return 0
+    return size
+
+
+def find_torrent(videos: List[Video], torrents: Dict[str, TorrentInfo]) -> Optional[str]:
+    """Find the torrent holding the files of videos cataloged without a hash.
+
+    A torrent holds a video if its content path is the video file, or its
+    root folder, which has to be below the save path. Torrents without a root
+    folder report the save path itself, which holds other torrents as well,
+    so they only match by file.
+    """
+    paths = [Path(video.path) for video in videos]
+    for hash_str, torrent in torrents.items():
+        content_path = torrent.get("content_path")
+        if not content_path:
+            continue
+        content_path = Path(content_path)
+        has_root = Path(torrent.get("save_path", "")) in content_path.parents
+        if any(
+            path == content_path or (has_root and content_path in path.parents)
+            for path in paths
+        ):
+            return hash_str
+    return None
+
+
+class StorageManager:
+    """Keeps the download folder under a quota by evicting what was watched least recently.
+
+    Once the folder grows over `quota` bytes, whole torrents are evicted,
+    least recently requested first, until it is down to `low_watermark` of
+    the quota, so a pass doesn't run again after every download. A torrent is
+    as recent as its most recently requested episode. Evicting a torrent
+    deletes it and its files in qBittorrent, deletes the faststart copies,
+    and removes its videos from the routes and the catalog.
+
+    Torrents that `is_busy` reports, e.g. with a task that is still
+    downloading or notifying, are never evicted.
+    """
+
+    def __init__(
+        self,
+        download_path: Path,
+        quota: int,
+        low_watermark: float,
+        video_repository: VideoRepository,
+        video_manager: VideoManager,
+        torrent_downloader: TorrentDownloader,
+        is_busy: Callable[[int], bool],
+    ) -> None:
+        self.download_path = download_path
+        self.quota = quota
+        self.low_watermark = low_watermark
+        self.video_repository = video_repository
+        self.video_manager = video_manager
+        self.torrent_downloader = torrent_downloader
+        self.is_busy = is_busy
+        # the disk usage seen by the last pass
+        self.usage: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.quota > 0
+
+    async def flush_access(self) -> None:
+        """Store the access times the routes recorded since the last flush."""
+        accesses = dict(self.video_manager.last_access)
+        self.video_manager.last_access.clear()
+        await self.video_repository.set_last_access(accesses)
+
+    async def enforce(self) -> None:
+        """Evict torrents until the download folder is under the quota again.
+
+        Returns right away if a pass is running already. Files are measured
+        and deleted off the event loop, so streaming goes on meanwhile.
+        """
+        if self._lock.locked():
+            return None
+
+        async with self._lock:
+            # kept without a quota as well, so one can be set later
+            await self.flush_access()
+            if not self.enabled:
+                return None
+
+            loop = asyncio.get_running_loop()
+            usage = await loop.run_in_executor(None, get_disk_usage, self.download_path)
+            self.usage = usage
+            if usage <= self.quota:
+                return None
+
+            target = self.quota * self.low_watermark
+            evicted = 0
+            freed = 0
+            torrents: Optional[Dict[str, TorrentInfo]] = None
+            for torrent_id, videos in await self._get_candidates():
+                if usage <= target:
+                    break
+
+                if torrents is None:
+                    torrents = dict(await self.torrent_downloader.sync_torrents())
+                size = await self._evict(torrent_id, videos, torrents)
+                if size is None:
+                    continue
+                usage -= size
+                freed += size
+                evicted += 1
+
+            self.usage = usage
+            logger.info(
+                f"Evicted {evicted} torrents, {freed / 1024**3:.2f} GiB freed, "
+                f"{usage / 1024**3:.2f} of {self.quota / 1024**3:.2f} GiB used."
+            )
+            if usage > target:
+                logger.warning(
+                    "The download folder is still over its quota, "
+                    "nothing else can be evicted."
+                )
+
+    async def _get_candidates(self) -> List[Tuple[int, List[Video]]]:
+        by_torrent: Dict[int, List[Video]] = {}
+        for video in await self.video_repository.all():
+            by_torrent.setdefault(video.torrent_id, []).append(video)
+
+        candidates = [
+            (torrent_id, videos)
+            for torrent_id, videos in by_torrent.items()
+            if not self.is_busy(torrent_id)
+        ]
+        # videos of older versions were never timed, they go first
+        candidates.sort(
+            key=lambda item: (max(video.last_access or 0 for video in item[1]), item[0])
+        )
+        return candidates
+
+    async def _evict(
+        self, torrent_id: int, videos: List[Video], torrents: Dict[str, TorrentInfo]
+    ) -> Optional[int]:
+        """Delete a torrent, its files and its videos.
+
+        Returns:
+            The bytes freed, or None if the torrent could not be deleted.
+        """
+        loop = asyncio.get_running_loop()
+        hash_str = videos[0].torrent_hash or find_torrent(videos, torrents)
+        torrent = torrents.get(hash_str) if hash_str is not None else None
+
+        if torrent is not None and torrent.get("progress", 1) < 1:
+            # downloading again, e.g. after a recheck
+            return None
+
+        paths = [video.faststart_path for video in videos]
+        if torrent is not None:
+            try:
+                await self.torrent_downloader.delete_torrent(torrent["hash"], delete_files=True)
+            except Exception as e:
+                logger.warning(f"Failed to delete torrent {torrent.get('name')}: {e}")
+                return None
+            # qBittorrent deletes the files in the background
+            size = torrent.get("size", 0)
+        else:
+            # removed from qBittorrent already, or not surely this torrent,
+            # so only its video files are deleted and every torrent is left alone
+            paths.extend(video.path for video in videos)
+            size = 0
+
+        size += sum(
+            await asyncio.gather(
+                *(loop.run_in_executor(None, remove_file, path) for path in paths)
+            )
+        )
+
+        for video in videos:
+            self.video_manager.remove_video(video.id)
+        await self.video_repository.delete_by_torrent(torrent_id)
+
+        STORAGE_EVICTED_BYTES.inc(size)
+        logger.success(f"Evicted {videos[0].title}, {size / 1024**2:.1f} MiB freed.")
+        return size
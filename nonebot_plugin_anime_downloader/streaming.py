@@ -0,0 +1,173 @@
+import time
+import asyncio
+from pathlib import Path
+from nonebot.log import logger
+from typing import List, Optional
+
+from .utils import VIDEO_SUFFIXES
+from .downloader import TorrentDownloader
+from .downloader.models import TorrentFile, TorrentInfo
+
+
+PIECE_DOWNLOADED = 2
+
+# piece states are shared by all requests of a stream for this long
+PIECE_STATES_TTL = 1.0
+
+# appended by qBittorrent to unfinished files with "Append .!qB extension"
+INCOMPLETE_SUFFIX = ".!qB"
+
+# how long a request waits for missing pieces before giving up
+PIECE_WAIT_TIMEOUT = 30.0
+PIECE_POLL_INTERVAL = 1.0
+
+
+class StreamingVideo:
+    """A video file of a torrent that is still downloading.
+
+    Maps byte ranges of the file to pieces of the torrent, so requests can
+    wait for the pieces they need instead of the whole download.
+
+    `path` is where the file is being downloaded to, `final_path` where
+    qBittorrent keeps it once finished. They differ with "Keep incomplete
+    torrents in" or "Append .!qB extension" set.
+    """
+
+    def __init__(
+        self,
+        downloader: TorrentDownloader,
+        hash_str: str,
+        path: Path,
+        offset: int,
+        size: int,
+        piece_size: int,
+        final_path: Optional[Path] = None,
+    ) -> None:
+        self.downloader = downloader
+        self.hash = hash_str
+        self.path = path
+        self.final_path = path if final_path is None else final_path
+        self.offset = offset  # of the file in the torrent
+        self.size = size
+        self.piece_size = piece_size
+        self._states: List[int] = []
+        self._updated = 0.0
+        self._lock = asyncio.Lock()
+
+    def _pieces(self, start: int, end: int) -> range:
+        return range(
+            (self.offset + start) // self.piece_size,
+            (self.offset + end) // self.piece_size + 1,
+        )
+
+    async def _refresh(self) -> None:
+        async with self._lock:
+            if time.monotonic() - self._updated < PIECE_STATES_TTL:
+                return None
+            self._states = await self.downloader.get_piece_states(self.hash)
+            self._updated = time.monotonic()
+
+    async def is_available(self, start: int, end: int) -> bool:
+        """Check whether every piece of a byte range of the file is downloaded.
+
+        Args:
+            start: The first byte of the range.
+            end: The last byte of the range, inclusive.
+        """
+        await self._refresh()
+        return all(
+            index < len(self._states) and self._states[index] == PIECE_DOWNLOADED
+            for index in self._pieces(start, end)
+        )
+
+    async def wait(self, start: int, end: int, timeout: Optional[float] = None) -> bool:
+        """Wait until a byte range of the file is downloaded.
+
+        Args:
+            start: The first byte of the range.
+            end: The last byte of the range, inclusive.
+            timeout: How long to wait, `PIECE_WAIT_TIMEOUT` by default.
+
+        Returns:
+            Whether the range became available before the timeout.
+        """
+        deadline = time.monotonic() + (PIECE_WAIT_TIMEOUT if timeout is None else timeout)
+        while not await self.is_available(start, end):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(PIECE_POLL_INTERVAL)
+        return True
+
+
+async def open_stream(
+    downloader: TorrentDownloader, torrent_info: TorrentInfo, buffer_size: int
+) -> Optional[StreamingVideo]:
+    """Open the largest video file of a torrent for streaming.
+
+    Args:
+        downloader: The torrent downloader.
+        torrent_info: The torrent.
+        buffer_size: How many leading bytes must be downloaded before the
+            video is worth watching.
+
+    Returns:
+        The stream, or None if the torrent has no video file or its leading
+        and last pieces are not downloaded yet.
+    """
+    hash_str = torrent_info["hash"]
+    files = sorted(await downloader.get_torrent_files(hash_str), key=lambda f: f["index"])
+    if not any(file["name"].lower().endswith(VIDEO_SUFFIXES) for file in files):
+        return None
+    piece_size = await downloader.get_piece_size(hash_str)
+
+    offset = 0
+    video_file: Optional[TorrentFile] = None
+    video_offset = 0
+    for file in files:
+        # qBittorrent leaves out the padding files of BEP 47, which align
+        # files to pieces, so the sizes alone fall short after the first pad
+        piece_range = file.get("piece_range")
+        if file["size"] > 0 and piece_range:
+            first_piece_start = piece_range[0] * piece_size
+            if not first_piece_start <= offset < first_piece_start + piece_size:
+                offset = first_piece_start
+
+        if file["name"].lower().endswith(VIDEO_SUFFIXES) and (
+            video_file is None or file["size"] > video_file["size"]
+        ):
+            video_file = file
+            video_offset = offset
+        offset += file["size"]
+
+    if video_file is None or video_file["size"] == 0:
+        return None
+
+    # unfinished torrents are kept in the download path when one is set
+    folder = Path(torrent_info.get("download_path") or torrent_info["save_path"])
+    path = folder / video_file["name"]
+    video = StreamingVideo(
+        downloader,
+        hash_str,
+        path,
+        video_offset,
+        video_file["size"],
+        piece_size,
+        final_path=Path(torrent_info["save_path"]) / video_file["name"],
+    )
+
+    # players read the head first, and the end for MP4s without faststart
+    if not await video.is_available(0, min(buffer_size, video.size) - 1):
+        return None
+    if not await video.is_available(video.size - 1, video.size - 1):
+        return None
+
+    for candidate in (path, path.with_name(path.name + INCOMPLETE_SUFFIX)):
+        if candidate.exists():
+            video.path = candidate
+            return video
+
+    logger.warning(
+        f"Can't find {path}, nor with the {INCOMPLETE_SUFFIX} extension, to stream it. "
+        "Is qBittorrent saving to another path than the bot sees?"
+    )
+    return None
@@ -1,24 +1,122 @@
+import os
 import json
-from typing import List
 from pathlib import Path
+from typing import Any, Dict, List, Optional
 
-from .models import Task
+from .models import Task, TaskContent
+from .downloader.models import TorrentInfo
+
+
+# rewrite the journal once it holds this many records more than live tasks
+COMPACT_THRESHOLD = 100
+
+
+def upgrade_task(task: Dict[str, Any]) -> Task:
+    """Convert a task of older versions, which had one recipient in `id`."""
+    if "id" in task:
+        task["ids"] = [task.pop("id")]
+    return task  # type: ignore
+
+
+def make_task_content(torrent_info: TorrentInfo) -> TaskContent:
+    return {
+        "hash": torrent_info["hash"],
+        "name": torrent_info["name"],
+        "save_path": torrent_info["save_path"],
+        "content_path": torrent_info.get("content_path", ""),
+    }
 
 
 class TaskManager:
+    """Tasks kept in memory and persisted to an append-only JSON lines journal.
+
+    Every change appends one small record, so a save costs the same no matter
+    how long the queue is, and a crash can at worst leave a torn last line,
+    which is skipped on load. The journal is compacted once it is mostly stale
+    records. A `tasks.json` written by older versions is imported on first use.
+
+    There is one task per torrent, keyed by its hash, which notifies all its
+    recipients. Per-recipient tasks of older versions are merged on import.
+    """
+
     def __init__(self, file_path: Path) -> None:
-        self.content: List[Task] = []
+        self._tasks: Dict[str, Task] = {}
         self._file_path = file_path
+        self._records = 0
 
+        legacy_file = file_path.with_suffix(".json")
         if file_path.exists():
-            self.content = json.loads(file_path.read_text("utf-8"))
-        else:
-            self.save()
+            self._load()
+        elif legacy_file.exists():
+            for task in json.loads(legacy_file.read_text("utf-8")):
+                task["content"] = make_task_content(task["content"])
+                self._put(upgrade_task(task))
+
+        self._compact()
 
-    def save(self) -> None:
-        with open(self._file_path, "w", encoding="utf-8") as f:
-            json.dump(self.content, f, indent=4, ensure_ascii=False)
+    @property
+    def content(self) -> List[Task]:
+        return list(self._tasks.values())
+
+    @staticmethod
+    def _key(task: Task) -> str:
+        return task["content"]["hash"]
+
+    def _put(self, task: Task) -> None:
+        existing = self._tasks.get(self._key(task))
+        if existing is not None and existing is not task:
+            # older versions kept a task per recipient of the same torrent
+            task["ids"] = list(dict.fromkeys(existing["ids"] + task["ids"]))
+        self._tasks[self._key(task)] = task
+
+    def _load(self) -> None:
+        with open(self._file_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._records += 1
+                if record["op"] == "put":
+                    self._tasks[self._key(record["task"])] = record["task"]
+                else:
+                    self._tasks.pop(record["key"], None)
+
+    def _append(self, record: dict) -> None:
+        with open(self._file_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._records += 1
+
+        if self._records > len(self._tasks) + COMPACT_THRESHOLD:
+            self._compact()
+
+    def _compact(self) -> None:
+        temp_path = self._file_path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for task in self._tasks.values():
+                f.write(json.dumps({"op": "put", "task": task}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._file_path)
+        self._records = len(self._tasks)
+
+    def find(self, torrent_id: int) -> Optional[Task]:
+        for task in self._tasks.values():
+            if task["torrent_id"] == torrent_id:
+                return task
+        return None
 
     def add(self, content: Task) -> None:
-        self.content.append(content)
-        self.save()
+        content["content"] = make_task_content(content["content"])
+        self.update(content)
+
+    def update(self, content: Task) -> None:
+        self._tasks[self._key(content)] = content
+        self._append({"op": "put", "task": content})
+
+    def remove(self, content: Task) -> None:
+        key = self._key(content)
+        if self._tasks.pop(key, None) is not None:
+            self._append({"op": "del", "key": key})
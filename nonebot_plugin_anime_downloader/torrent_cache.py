@@ -0,0 +1,65 @@
+import os
+from pathlib import Path
+from typing import Optional
+
+from .downloader.bencode import get_info_hashes
+from .downloader.exceptions import InvalidTorrentError
+
+
+class TorrentCache:
+    """Content-addressed on-disk cache of .torrent files.
+
+    Files are stored once under their info hash in `objects/`, and each
+    ACG.RIP id points at one of them from `ids/`, so reposts of the same
+    torrent share a file. Cached files are checked against their hash when
+    read, and only valid torrent files are ever stored, so an error page
+    served instead of a torrent can't poison the cache.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.objects_dir = directory / "objects"
+        self.ids_dir = directory / "ids"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.ids_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, torrent_id: int) -> Optional[bytes]:
+        id_file = self.ids_dir / str(torrent_id)
+        try:
+            info_hash = id_file.read_text("utf-8").strip()
+            torrent_file = (self.objects_dir / f"{info_hash}.torrent").read_bytes()
+        except FileNotFoundError:
+            return None
+
+        try:
+            valid = get_info_hashes(torrent_file).id == info_hash
+        except InvalidTorrentError:
+            valid = False
+        if not valid:
+            id_file.unlink(missing_ok=True)
+            return None
+
+        return torrent_file
+
+    def put(self, torrent_id: int, torrent_file: bytes) -> str:
+        """Store a .torrent file for an ACG.RIP id.
+
+        Returns:
+            The info hash of the torrent.
+
+        Raises:
+            InvalidTorrentError: If the data is not a torrent file.
+        """
+        info_hash = get_info_hashes(torrent_file).id
+
+        object_file = self.objects_dir / f"{info_hash}.torrent"
+        if not object_file.exists():
+            self._write(object_file, torrent_file)
+        self._write(self.ids_dir / str(torrent_id), info_hash.encode())
+
+        return info_hash
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> None:
+        temp_path = path.with_name(f"{path.name}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
@@ -0,0 +1,233 @@
+import time
+import random
+import cProfile
+import functools
+import contextvars
+from pathlib import Path
+from collections import deque
+from datetime import datetime
+from nonebot.log import logger
+from contextlib import asynccontextmanager, contextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Span:
+    __slots__ = ("name", "start", "duration", "children")
+
+    def __init__(self, name: str, start: float, duration: Optional[float] = None) -> None:
+        self.name = name
+        self.start = start  # seconds since the start of the trace
+        self.duration = duration  # None while the span is open
+        self.children: List["Span"] = []
+
+
+class Trace:
+    """The span tree of one run of a job.
+
+    Work the run hands off, like downloads queued in the pipeline, may keep
+    adding spans after the run itself has finished.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started_at = datetime.now()
+        self.root = Span(name, 0.0)
+        self.profile_path: Optional[Path] = None
+        self._start = time.perf_counter()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def summary(self) -> str:
+        profiled = ", profiled" if self.profile_path is not None else ""
+        return (
+            f"{self.name} at {self.started_at:%m-%d %H:%M:%S}: "
+            f"{_format_duration(self.root.duration)}{profiled}"
+        )
+
+    def render(self) -> str:
+        lines = [self.summary()]
+        _render_children(self.root, 1, lines)
+        if self.profile_path is not None:
+            lines.append(f"profile: {self.profile_path}")
+        return "\n".join(lines)
+
+
+def _format_duration(duration: Optional[float]) -> str:
+    return "running" if duration is None else f"{duration * 1000:.1f} ms"
+
+
+def _render_children(span: Span, depth: int, lines: List[str]) -> None:
+    # a run can match dozens of entries, which interleave in the pipeline,
+    # so siblings of the same name share a line
+    groups: Dict[str, List[Span]] = {}
+    for child in span.children:
+        groups.setdefault(child.name, []).append(child)
+
+    indent = "  " * depth
+    for group in groups.values():
+        finished = [child.duration for child in group if child.duration is not None]
+        slowest = max(group, key=lambda child: child.duration or 0.0)
+        if len(group) == 1:
+            lines.append(
+                f"{indent}{slowest.name} +{slowest.start * 1000:.1f} ms: "
+                f"{_format_duration(slowest.duration)}"
+            )
+        else:
+            lines.append(
+                f"{indent}{slowest.name} x{len(group)} +{group[0].start * 1000:.1f} ms: "
+                f"{sum(finished) * 1000:.1f} ms total, "
+                f"{max(finished, default=0) * 1000:.1f} ms max"
+            )
+        # only the slowest of a group is broken down further
+        _render_children(slowest, depth + 1, lines)
+
+
+_current: "contextvars.ContextVar[Optional[Tuple[Trace, Span]]]" = contextvars.ContextVar(
+    "anime_downloader_span", default=None
+)
+
+
+def current_trace() -> Optional[Trace]:
+    current = _current.get()
+    return None if current is None else current[0]
+
+
+@contextmanager
+def span(name: str, trace: Optional[Trace] = None) -> Iterator[None]:
+    """Time a stage as a child of the current span.
+
+    Does nothing outside a traced run, so stages can be wrapped freely.
+
+    Args:
+        name: The name of the stage.
+        trace: A trace to add the span to at the top level, for work a run
+            handed off to another task.
+    """
+    if trace is not None:
+        parent: Optional[Tuple[Trace, Span]] = (trace, trace.root)
+    else:
+        parent = _current.get()
+    if parent is None:
+        yield None
+        return None
+
+    parent_trace, parent_span = parent
+    child = Span(name, parent_trace.elapsed())
+    parent_span.children.append(child)
+    token = _current.set((parent_trace, child))
+    try:
+        yield None
+    finally:
+        child.duration = parent_trace.elapsed() - child.start
+        _current.reset(token)
+
+
+def add_span(name: str, duration: float) -> None:
+    """Record a stage that was timed piecewise, like parsing interleaved with a download."""
+    current = _current.get()
+    if current is None:
+        return None
+    trace, parent = current
+    parent.children.append(Span(name, trace.elapsed() - duration, duration))
+
+
+class Tracer:
+    """Keeps the traces of the last runs of the scheduled jobs.
+
+    A sampled share of runs is profiled with cProfile, and the profile is
+    dumped when the run is slower than the threshold. cProfile sees the whole
+    event loop thread, so the profile also includes whatever ran meanwhile.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        size: int,
+        profile_dir: Path,
+        profile_threshold: float = 0,
+        profile_sample_rate: float = 0,
+    ) -> None:
+        self.enabled = enabled
+        self.traces: Deque[Trace] = deque(maxlen=size)
+        self.profile_dir = profile_dir
+        self.profile_threshold = profile_threshold
+        self.profile_sample_rate = profile_sample_rate
+        # only one profiler can be active at a time
+        self._profiling = False
+
+    @asynccontextmanager
+    async def trace(self, name: str) -> AsyncIterator[Optional[Trace]]:
+        if not self.enabled:
+            yield None
+            return
+
+        trace = Trace(name)
+        token = _current.set((trace, trace.root))
+        profiler = self._start_profiler()
+        try:
+            yield trace
+        finally:
+            trace.root.duration = trace.elapsed()
+            _current.reset(token)
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                if trace.root.duration >= self.profile_threshold:
+                    self._dump(trace, profiler)
+            self.traces.append(trace)
+
+    def traced(self, name: str) -> Callable[[F], F]:
+        def decorator(function: F) -> F:
+            @functools.wraps(function)
+            async def wrapper(*args: Any, **kwargs: Any) -> Any:
+                async with self.trace(name):
+                    return await function(*args, **kwargs)
+
+            return wrapper  # type: ignore
+
+        return decorator
+
+    def _start_profiler(self) -> Optional[cProfile.Profile]:
+        if (
+            self.profile_threshold <= 0
+            or self._profiling
+            or random.random() >= self.profile_sample_rate
+        ):
+            return None
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler, e.g. a debugger, is active
+            return None
+        self._profiling = True
+        return profiler
+
+    def _dump(self, trace: Trace, profiler: cProfile.Profile) -> None:
+        path = self.profile_dir / f"{trace.name}-{trace.started_at:%Y%m%d-%H%M%S-%f}.prof"
+        try:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(path)
+        except OSError as e:
+            logger.warning(f"Failed to dump the profile of {trace.name}: {e}")
+            return None
+        trace.profile_path = path
+        logger.info(
+            f"{trace.name} took {trace.root.duration or 0:.2f}s, profile dumped to {path}."
+        )
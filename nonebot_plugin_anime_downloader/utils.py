@@ -1,6 +1,25 @@
 import re
-import opencc
-from typing import List
+from pathlib import Path
+from typing import TYPE_CHECKING, List
+from functools import lru_cache
+
+if TYPE_CHECKING:
+    import opencc
+
+
+VIDEO_SUFFIXES = (".mp4", ".mkv", ".webm", ".avi", ".mov", ".ts", ".flv", ".m4v")
+
+
+@lru_cache(maxsize=None)
+def get_converter() -> "opencc.OpenCC":
+    """Get the shared traditional to simplified Chinese converter.
+
+    Returns:
+        The OpenCC converter, imported and built on first use.
+    """
+    import opencc
+
+    return opencc.OpenCC("t2s.json")
 
 
 def traditional_to_simplified(traditional_text: str) -> str:
@@ -12,11 +31,22 @@ def traditional_to_simplified(traditional_text: str) -> str:
     Returns:
         The simplified Chinese text.
     """
-    converter = opencc.OpenCC("t2s.json")
-    simplified_text = converter.convert(traditional_text)
+    simplified_text = get_converter().convert(traditional_text)
     return simplified_text
 
 
+def normalize_text(text: str) -> str:
+    """Normalize text for matching: simplified Chinese, lowercased.
+
+    Args:
+        text: The text to normalize.
+
+    Returns:
+        The normalized text.
+    """
+    return traditional_to_simplified(text).lower()
+
+
 def is_tag_match_title(tags: List[str], title: str) -> bool:
     """Check if any of the tags match the title.
     Example:
@@ -31,8 +61,8 @@ def is_tag_match_title(tags: List[str], title: str) -> bool:
     Returns:
       True if any of the tags match the title, False otherwise.
     """
-    title = traditional_to_simplified(title).lower()
-    tags = [traditional_to_simplified(tag.lower()) for tag in tags]
+    title = normalize_text(title)
+    tags = [normalize_text(tag) for tag in tags]
 
     return all(tag in title for tag in tags)
 
@@ -94,6 +124,30 @@ def extract_tags_from_title(title: str) -> List[str]:
     return tags
 
 
+def find_videos(content_path: Path) -> List[Path]:
+    """Find the video files of a downloaded torrent.
+
+    Example:
+        find_videos(Path("/downloads/Show/[Sub] Show 01.mkv")) -> [Path("/downloads/Show/[Sub] Show 01.mkv")]
+        find_videos(Path("/downloads/Show/[Sub] Show S1")) -> [Path(".../[Sub] Show 01.mkv"), Path(".../[Sub] Show 02.mkv"), ...]
+
+    Args:
+        content_path: The file of a single-file torrent, or the root folder
+            of a multi-file torrent.
+
+    Returns:
+        A list of video file paths, sorted by path.
+    """
+    if content_path.is_file():
+        paths = [content_path]
+    elif content_path.is_dir():
+        paths = [path for path in content_path.rglob("*") if path.is_file()]
+    else:
+        return []
+
+    return sorted(path for path in paths if path.suffix.lower() in VIDEO_SUFFIXES)
+
+
 if __name__ == "__main__":
     print(
         is_tag_match_title(
@@ -107,3 +161,4 @@ if __name__ == "__main__":
             "[北宇治字幕组] GIRLS BAND CRY [04][WebRip][HEVC_AAC][简体内嵌]",
         )
     )
+
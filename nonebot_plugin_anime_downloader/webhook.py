@@ -0,0 +1,36 @@
+import secrets
+from nonebot.log import logger
+from typing import Awaitable, Callable
+from fastapi import FastAPI, Header, HTTPException
+
+
+def register_webhook(
+    app: FastAPI, token: str, on_torrent_finished: Callable[[str], Awaitable[bool]]
+) -> None:
+    """Register the endpoint qBittorrent calls when a torrent finishes.
+
+    Set "Run external program on torrent finished" in qBittorrent to
+    `curl -X POST -H "Authorization: Bearer <token>" "<host>/anime_downloader/torrent_finished?hash=%I"`.
+
+    Args:
+        app: The FastAPI app of the driver.
+        token: The secret the caller has to present as a bearer token.
+        on_torrent_finished: Called with the info hash, returns whether a
+            task was waiting for the torrent.
+    """
+    if not isinstance(app, FastAPI):
+        raise TypeError("app must be an instance of FastAPI.")
+
+    @app.post("/anime_downloader/torrent_finished")
+    async def torrent_finished(hash: str, authorization: str = Header("")):
+        # compare_digest only takes ASCII str, so the raw header bytes, which
+        # Starlette decoded as latin-1, are compared with the encoded token
+        if not secrets.compare_digest(
+            authorization.encode("latin-1"), f"Bearer {token}".encode()
+        ):
+            raise HTTPException(status_code=401, detail="Invalid token.")
+
+        logger.info(f"qBittorrent reported torrent {hash} finished.")
+        if not await on_torrent_finished(hash.lower()):
+            raise HTTPException(status_code=404, detail="No task for this torrent.")
+        return {"status": "ok"}